@@ -1,11 +1,10 @@
 from helpers.load_config import load_config
 from helpers.logger import logger
-from open_ai.openai_wrapper import get_openai
 from rabbitmq.rabbitmq_connection import get_rabbitmq
-from rabbitmq.rabbitmq_consumer import subscribe_to_rabbitmq
 from rabbitmq.rabbitmq_filler import supabase_to_rabbitmq
-from stable_diffusion.stable_diffusion_manager import get_stable_diffusion
-from supabase_helpers.supabase_connection import get_supabase_postgres
+from rabbitmq.rabbitmq_supervisor import supervise_consumers
+from rabbitmq.rabbitmq_writer import rabbitmq_to_supabase
+from supabase_helpers.supabase_connection import get_supabase_postgres_pool
 
 if __name__ == "__main__":
     logger.info("Brand name here...")
@@ -13,17 +12,17 @@ if __name__ == "__main__":
     logger.info("Starting up... Specified mode: %s", config.MODE)
 
     # Ensure all required services are available before starting
-    get_rabbitmq()
-    get_supabase_postgres()
+    get_supabase_postgres_pool()
 
     if config.MODE == "consumer":
         logger.info("Starting in consumer mode")
-        get_stable_diffusion()
-        get_openai()
-
-        subscribe_to_rabbitmq()
+        supervise_consumers()
     elif config.MODE == "filler":
         logger.info("Starting in filler mode")
+        get_rabbitmq()
         supabase_to_rabbitmq()
+    elif config.MODE == "writer":
+        logger.info("Starting in writer mode")
+        rabbitmq_to_supabase()
     else:
-        logger.error("Invalid mode. Make sure you have set the MODE environment variable to either 'consumer' or 'filler'... Aborting startup!")
\ No newline at end of file
+        logger.error("Invalid mode. Make sure you have set the MODE environment variable to either 'consumer', 'filler' or 'writer'... Aborting startup!")
\ No newline at end of file
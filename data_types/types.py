@@ -2,7 +2,7 @@ import json
 from dataclasses import dataclass, asdict, field
 from datetime import datetime
 from enum import Enum
-from typing import List, Optional, Any, TypedDict, Dict
+from typing import List, Optional, Any, TypedDict, Dict, Union
 
 
 class JobType(Enum):
@@ -36,6 +36,8 @@ class TextToImageRequestType:
     plugins: Optional[List[ImagePluginType]] = field(default_factory=list)
     negative_prompt: Optional[str] = None
     seed: Optional[int] = None
+    output_format: Optional[str] = None  # png, webp, avif or jpeg, the configured OUTPUT_FORMAT if not set
+    output_quality: Optional[int] = None  # 1 to 100 for lossy formats, the configured OUTPUT_QUALITY if not set
 
     def json(self):
         data_dict = asdict(self)
@@ -54,7 +56,9 @@ class TextToImageRequestType:
             width=data.get('width', 1024),
             plugins=plugins,
             negative_prompt=data.get('negative_prompt'),
-            seed=data.get('seed')
+            seed=data.get('seed'),
+            output_format=data.get('output_format'),
+            output_quality=data.get('output_quality')
         )
 
 @dataclass
@@ -90,9 +94,13 @@ class SupabaseJobQueueType:
 
 @dataclass
 class StableDiffusionExecutionType:
-    image: bytes
+    image: Optional[Union[bytes, memoryview]]  # encoded image, a view of the encoder's buffer until it is uploaded
     seed: int
     runtime: int
+    raw_image: Optional[Any] = None  # decoded uint8 (height, width, 3) image waiting to be encoded by the post-processing stage
+    output_format: str = "png"
+    output_quality: Optional[int] = None
+    step_durations: Optional[List[float]] = None  # denoising step durations (ms) of the pipeline call that generated the image
 
     def json(self):
         data_dict = asdict(self)
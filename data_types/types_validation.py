@@ -1,5 +1,6 @@
 from typing import Optional
 from pydantic import BaseModel, Field, field_validator
+from helpers.image_formats import is_format_supported
 
 class TextToImageRequestModel(BaseModel):
     prompt: str = Field(..., min_length=1, description="Prompt for generating images")
@@ -8,6 +9,8 @@ class TextToImageRequestModel(BaseModel):
     height: int = Field(1024, gt=0, description="Height of the generated image")
     width: int = Field(1024, gt=0, description="Width of the generated image")
     seed: Optional[int] = None
+    output_format: Optional[str] = Field(None, description="Format of the generated images (png, webp, avif or jpeg)")
+    output_quality: Optional[int] = Field(None, ge=1, le=100, description="Quality of lossy output formats")
 
     @field_validator('prompt', mode='before')
     @classmethod
@@ -16,6 +19,13 @@ class TextToImageRequestModel(BaseModel):
             raise ValueError("Prompt cannot be empty")
         return value
 
+    @field_validator('output_format')
+    @classmethod
+    def validate_output_format(cls, value):
+        if value is not None and not is_format_supported(value):
+            raise ValueError(f"Output format is not supported: {value}")
+        return value
+
 
 class SupabaseJobQueueType(BaseModel):
     id: str = Field(..., description="job id")
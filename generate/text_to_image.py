@@ -1,12 +1,12 @@
 from pydantic import ValidationError
 from data_types.types_validation import TextToImageRequestModel
+from helpers.timing import time_stage
 from moderate.sanitize_prompt import sanitize_prompt
-from stable_diffusion.stable_diffusion_manager import get_stable_diffusion
-from data_types.types import StableDiffusionExecutionType, SupabaseJobQueueType
-from supabase_helpers.supabase_images import create_supabase_image_entities
+from data_types.types import SupabaseJobQueueType, TextToImageRequestType
 from supabase_helpers.supabase_team import team_nsfw_allowed
 
-def text_to_image(request: SupabaseJobQueueType) -> list[StableDiffusionExecutionType]:
+# Validate and moderate a text-to-image request before it is handed to the GPU
+def validate_text_to_image(request: SupabaseJobQueueType) -> TextToImageRequestType:
     # Validate Input
     request_data = request.request_data
     if request_data is None:
@@ -18,20 +18,8 @@ def text_to_image(request: SupabaseJobQueueType) -> list[StableDiffusionExecutio
         raise Exception(f"invalid request data: {e.errors()}")
 
     # Moderate Input
-    nsfw_allowed = team_nsfw_allowed(request.team)
+    with time_stage("team_lookup"):
+        nsfw_allowed = team_nsfw_allowed(request.team)
     sanitize_prompt(request_data.prompt, nsfw_allowed=nsfw_allowed)
 
-    # Generate Image(s)
-    images = []
-    stable_diffusion = get_stable_diffusion()
-    for _ in range(request_data.num_options):
-        # Generate image with stable diffusion
-        response = stable_diffusion.text_to_image(request_data)
-        images.append(response)
-
-        try:
-            create_supabase_image_entities([response], request)
-        except Exception:
-            raise Exception(f"Image upload failed")
-
-    return images
\ No newline at end of file
+    return request_data
@@ -1,11 +1,10 @@
 from pydantic import ValidationError
 from data_types.types_validation import TextToImageRequestModel
-from data_types.types import StableDiffusionExecutionType, SupabaseJobQueueType
+from data_types.types import SupabaseJobQueueType, TextToImageRequestType
 from moderate.sanitize_prompt import sanitize_prompt
-from stable_diffusion.stable_diffusion_manager import get_stable_diffusion
-from supabase_helpers.supabase_images import create_supabase_image_entities
 
-def text_to_portrait(request: SupabaseJobQueueType) -> list[StableDiffusionExecutionType]:
+# Validate and moderate a text-to-portrait request before it is handed to the GPU
+def validate_text_to_portrait(request: SupabaseJobQueueType) -> TextToImageRequestType:
     # Validate Input
     request_data = request.request_data
     if request_data is None:
@@ -19,17 +18,4 @@ def text_to_portrait(request: SupabaseJobQueueType) -> list[StableDiffusionExecu
     # Moderate Input
     sanitize_prompt(request_data.prompt, nsfw_allowed=False)
 
-    # Generate Image(s)
-    images = []
-    stable_diffusion = get_stable_diffusion()
-    for _ in range(request_data.num_options):
-        # Generate image with stable diffusion
-        response = stable_diffusion.text_to_image(request_data)
-        images.append(response)
-
-        try:
-            create_supabase_image_entities([response], request)
-        except Exception:
-            raise Exception(f"Image upload failed")
-
-    return images
\ No newline at end of file
+    return request_data
@@ -1,11 +1,30 @@
 import torch
+from helpers.load_config import load_config
 from helpers.logger import logger
 
-def get_device():
+config = load_config()
+
+# Devices the consumer runs a worker on: the configured list, every visible GPU or CONSUMER_CPU_WORKERS times the CPU
+def get_consumer_devices() -> list[str]:
+    if config.CONSUMER_DEVICES:
+        return [device.strip() for device in config.CONSUMER_DEVICES.split(",") if device.strip()]
     if torch.cuda.is_available():
-        gpu_name = torch.cuda.get_device_name(0)
-        logger.info(f"CUDA detected. Using GPU: {gpu_name}")
-        return "cuda"
+        return [f"cuda:{index}" for index in range(torch.cuda.device_count())]
+    return ["cpu"] * max(1, config.CONSUMER_CPU_WORKERS)
+
+def is_cuda_device(device: str) -> bool:
+    return device.startswith("cuda")
+
+# Device of this process, the one assigned by the consumer supervisor or the first GPU
+def get_device():
+    device = config.WORKER_DEVICE
+    if not device:
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+
+    if is_cuda_device(device):
+        torch.cuda.set_device(device)
+        gpu_name = torch.cuda.get_device_name(device)
+        logger.info(f"CUDA detected. Using GPU: {gpu_name} ({device})")
     else:
         logger.error("CUDA not detected. Using CPU instead. This may lead to inefficient performance.")
-        return "cpu"
\ No newline at end of file
+    return device
@@ -1,8 +1,10 @@
 from helpers.load_config import load_config
+from helpers.timing import JobTimings
 config = load_config()
 
 
-def create_execution_metadata(runtime: float, data: dict = None):
+# timings adds the per-stage breakdown, e.g. execution_metadata->'timings'->>'denoise_ms'
+def create_execution_metadata(runtime: float, data: dict = None, timings: JobTimings = None):
     execution_metadata = {
         "gpu": config.NODE_GPU,
         "node_id": config.NODE_ID
@@ -14,4 +16,7 @@ def create_execution_metadata(runtime: float, data: dict = None):
     if data is not None:
         execution_metadata.update(data)
 
+    if timings is not None:
+        execution_metadata["timings"] = timings.json()
+
     return execution_metadata
\ No newline at end of file
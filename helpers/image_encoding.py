@@ -0,0 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+from helpers.image_formats import ImageFormat, encode_image, get_image_format
+from helpers.load_config import load_config
+from helpers.timing import time_stage
+
+config = load_config()
+_encodeExecutor: ThreadPoolExecutor = None
+
+# The image codecs release the GIL while compressing, so encoding threads run in parallel without copying pixels to other processes
+def get_encode_executor() -> ThreadPoolExecutor:
+    global _encodeExecutor
+    if _encodeExecutor is None:
+        _encodeExecutor = ThreadPoolExecutor(max_workers=config.IMAGE_ENCODE_WORKERS, thread_name_prefix="image-encode")
+    return _encodeExecutor
+
+# Output format of a request, the configured default if the request does not specify one
+def get_output_format(output_format: Optional[str]) -> ImageFormat:
+    return get_image_format(output_format or config.OUTPUT_FORMAT)
+
+def get_output_quality(output_quality: Optional[int]) -> int:
+    return output_quality or config.OUTPUT_QUALITY
+
+# Encode several images concurrently, each in its own format and quality, keeping their order
+def encode_images(images: list[Any], output_formats: list[Optional[str]], output_qualities: list[Optional[int]]) -> list[memoryview]:
+    def encode(image, output_format, output_quality):
+        return encode_image(image, get_output_format(output_format), get_output_quality(output_quality), config.PNG_COMPRESS_LEVEL)
+
+    with time_stage("encode"):
+        return list(get_encode_executor().map(encode, images, output_formats, output_qualities))
@@ -0,0 +1,59 @@
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Any, Optional
+from PIL import Image, features
+
+@dataclass(frozen=True)
+class ImageFormat:
+    name: str
+    pil_format: str
+    extension: str
+    content_type: str
+    lossy: bool
+
+IMAGE_FORMATS = {
+    "png": ImageFormat(name="png", pil_format="PNG", extension="png", content_type="image/png", lossy=False),
+    "webp": ImageFormat(name="webp", pil_format="WEBP", extension="webp", content_type="image/webp", lossy=True),
+    "avif": ImageFormat(name="avif", pil_format="AVIF", extension="avif", content_type="image/avif", lossy=True),
+    "jpeg": ImageFormat(name="jpeg", pil_format="JPEG", extension="jpg", content_type="image/jpeg", lossy=True),
+}
+
+# Pillow only ships an AVIF encoder since 11.3, older versions need the pillow-avif-plugin package
+def is_format_supported(name: str) -> bool:
+    if name not in IMAGE_FORMATS:
+        return False
+    if name == "avif" and not features.check("avif"):
+        try:
+            import pillow_avif  # noqa: F401 registers the AVIF encoder
+        except ImportError:
+            return False
+    return True
+
+def get_image_format(name: str) -> ImageFormat:
+    if not is_format_supported(name):
+        raise Exception(f"unsupported output format: {name}")
+    return IMAGE_FORMATS[name]
+
+# Encode an image (PIL image or uint8 array) in the given format. The result is a view of the encoder's buffer, no copy is made.
+# quality (1-100) only applies to lossy formats, compress_level (0-9) only to PNG.
+def encode_image(image: Any, image_format: ImageFormat, quality: Optional[int] = None, compress_level: int = 6) -> memoryview:
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(image)
+
+    options = {}
+    if image_format.name == "png":
+        options["compress_level"] = compress_level
+    elif image_format.name == "webp":
+        options["quality"] = quality
+        options["method"] = 4
+    elif image_format.name == "avif":
+        options["quality"] = quality
+        options["speed"] = 8
+    elif image_format.name == "jpeg":
+        options["quality"] = quality
+        options["progressive"] = True
+        options["optimize"] = True
+
+    img_io = BytesIO()
+    image.save(img_io, image_format.pil_format, **options)
+    return img_io.getbuffer()
@@ -14,20 +14,83 @@ class Config(BaseSettings):
     SUPABASE_POSTGRES_HOST: str = Field(..., alias='SUPABASE_POSTGRES_HOST')  # Required
     SUPABASE_POSTGRES_PORT: int = Field(..., alias='SUPABASE_POSTGRES_PORT')  # Required
 
+    POSTGRES_POOL_MIN: int = Field(1, alias='POSTGRES_POOL_MIN')
+    POSTGRES_POOL_MAX: int = Field(10, alias='POSTGRES_POOL_MAX')
+    POSTGRES_POOL_HEALTHCHECK_IDLE: int = Field(30, alias='POSTGRES_POOL_HEALTHCHECK_IDLE')  # seconds of idleness after which a connection is pinged on checkout
+    PLUGIN_SYNC_INTERVAL: int = Field(60, alias='PLUGIN_SYNC_INTERVAL')  # seconds between syncs of the plugin list
+    PLUGIN_PREFETCH: bool = Field(True, alias='PLUGIN_PREFETCH')  # download new plugins in the background instead of on first use
+    MODEL_LOAD_WORKERS: int = Field(4, alias='MODEL_LOAD_WORKERS')  # pipeline components loaded in parallel
+    PIPELINE_COMPILE: bool = Field(False, alias='PIPELINE_COMPILE')  # torch.compile the UNet and VAE decoder for the warm-up resolutions and batch sizes, the UNet runs eager once a plugin was loaded
+    PIPELINE_COMPILE_MODE: str = Field("default", alias='PIPELINE_COMPILE_MODE')
+    PIPELINE_COMPILE_CACHE_DIR: str = Field("./compile_cache", alias='PIPELINE_COMPILE_CACHE_DIR')
+    PIPELINE_WARMUP_RESOLUTIONS: str = Field("", alias='PIPELINE_WARMUP_RESOLUTIONS')  # comma separated, e.g. "1024x1024,1152x896"
+    PIPELINE_WARMUP_STEPS: int = Field(2, alias='PIPELINE_WARMUP_STEPS')
+    PIPELINE_WARMUP_BATCH_SIZES: str = Field("1", alias='PIPELINE_WARMUP_BATCH_SIZES')  # comma separated images per pipeline call, compiled graphs only serve these
+    LORA_CACHE_MAX_ADAPTERS: int = Field(32, alias='LORA_CACHE_MAX_ADAPTERS')  # plugins kept loaded into the pipeline
+    LORA_CACHE_MAX_MB: int = Field(2048, alias='LORA_CACHE_MAX_MB')  # combined size of the plugins kept loaded
+    LORA_FUSION_TOP_K: int = Field(4, alias='LORA_FUSION_TOP_K')  # most frequent plugin combinations fused into the base weights, 0 disables fusion
+    LORA_FUSION_MIN_COUNT: int = Field(20, alias='LORA_FUSION_MIN_COUNT')  # images a combination needs within the window to be fused
+    LORA_FUSION_WINDOW: int = Field(1000, alias='LORA_FUSION_WINDOW')  # recent images the combination frequency is counted over
+    LORA_FUSION_MAX_MB: int = Field(4096, alias='LORA_FUSION_MAX_MB')  # combined size of the cached fused deltas
+    LORA_FUSION_DEVICE: str = Field("cpu", alias='LORA_FUSION_DEVICE')  # where fused deltas and base weight snapshots are kept
+    PROMPT_EMBEDDING_CACHE_MB: int = Field(256, alias='PROMPT_EMBEDDING_CACHE_MB')  # text encoder outputs kept on the device, 0 disables the cache
+    TEAM_SETTINGS_TTL: int = Field(300, alias='TEAM_SETTINGS_TTL')  # seconds between bulk refreshes of the team settings, changes are also pushed via NOTIFY
+
     RABBITMQ_HOST: str = Field(..., alias='RABBITMQ_HOST')  # Required
     RABBITMQ_QUEUE: str = Field(..., alias='RABBITMQ_QUEUE')  # Required
     RABBITMQ_QUEUE_SIZE: int = Field(..., alias='RABBITMQ_QUEUE_SIZE')  # Required
     RABBITMQ_DEFAULT_USER: str = Field(..., alias='RABBITMQ_DEFAULT_USER')  # Required
     RABBITMQ_DEFAULT_PASS: str = Field(..., alias='RABBITMQ_DEFAULT_PASS')  # Required
     RABBITMQ_DEFAULT_VHOST: str = Field(..., alias='RABBITMQ_DEFAULT_VHOST')
+    RABBITMQ_RESULTS_QUEUE: str = Field("job_results", alias='RABBITMQ_RESULTS_QUEUE')
+
+    JOB_STATUS_WRITER: bool = Field(False, alias='JOB_STATUS_WRITER')  # consumers publish job status updates for MODE=writer instead of writing them
+    WRITER_BATCH_SIZE: int = Field(200, alias='WRITER_BATCH_SIZE')
+    WRITER_BATCH_MAX_WAIT_MS: int = Field(500, alias='WRITER_BATCH_MAX_WAIT_MS')
+
+    FILLER_POLL_INTERVAL: int = Field(30, alias='FILLER_POLL_INTERVAL')  # seconds, safety net in case a notification is missed
+    FILLER_DRAIN_CHECK_INTERVAL_MS: int = Field(1000, alias='FILLER_DRAIN_CHECK_INTERVAL_MS')
+    PUBLISH_CONFIRM_TIMEOUT_MS: int = Field(5000, alias='PUBLISH_CONFIRM_TIMEOUT_MS')
 
     JOB_DISCARD_THRESHOLD: int = Field(1440, alias='JOB_DISCARD_THRESHOLD')  # Required
+    METRICS_PORT: int = Field(9464, alias='METRICS_PORT')  # /metrics endpoint of consumer and filler, 0 disables it. Consumer workers use the following ports
     LOGGING_LEVEL: str = Field("INFO", alias='LOGGING_LEVEL')
     OPENAI_KEY: str = Field(..., alias='OPENAI_KEY')  # Required
+    MODERATION_CACHE_SIZE: int = Field(10000, alias='MODERATION_CACHE_SIZE')
+    MODERATION_CACHE_TTL: int = Field(86400, alias='MODERATION_CACHE_TTL')  # seconds
+    MODERATION_BATCH_SIZE: int = Field(32, alias='MODERATION_BATCH_SIZE')  # prompts per moderation request
+    MODERATION_BATCH_WINDOW_MS: int = Field(25, alias='MODERATION_BATCH_WINDOW_MS')  # time concurrent prompts wait to share a request, 0 disables
 
     NODE_GPU: str = Field(..., alias='NODE_GPU')  # Required
     NODE_ID: str = Field(..., alias='NODE_ID')  # Required
 
+    RABBITMQ_PREFETCH_COUNT: int = Field(4, alias='RABBITMQ_PREFETCH_COUNT')  # unacknowledged jobs per consumer, including jobs being admitted or stored
+    CONSUMER_ADMISSION_WORKERS: int = Field(4, alias='CONSUMER_ADMISSION_WORKERS')
+    CONSUMER_BATCH_SIZE: int = Field(1, alias='CONSUMER_BATCH_SIZE')  # 1 disables cross-job batching
+    CONSUMER_BATCH_MAX_WAIT_MS: int = Field(250, alias='CONSUMER_BATCH_MAX_WAIT_MS')
+    CONSUMER_DEVICES: str = Field("", alias='CONSUMER_DEVICES')  # comma separated devices to run a worker on (e.g. "cuda:0,cuda:2"), defaults to every visible GPU
+    CONSUMER_CPU_WORKERS: int = Field(1, alias='CONSUMER_CPU_WORKERS')  # workers to run when no GPU is visible
+    WORKER_DEVICE: str = Field("", alias='WORKER_DEVICE')  # set by the consumer supervisor for each worker process
+    WORKER_METRICS_PORT: int = Field(0, alias='WORKER_METRICS_PORT')  # set by the consumer supervisor for each worker process
+    WORKER_HEARTBEAT_INTERVAL: int = Field(10, alias='WORKER_HEARTBEAT_INTERVAL')  # seconds
+    WORKER_RESTART_DELAY: int = Field(5, alias='WORKER_RESTART_DELAY')  # seconds, doubled for workers crashing before they are ready
+    POSTPROCESS_WORKERS: int = Field(2, alias='POSTPROCESS_WORKERS')
+    POSTPROCESS_QUEUE_SIZE: int = Field(4, alias='POSTPROCESS_QUEUE_SIZE')  # finished jobs waiting for upload before the GPU is paused
+
+    PROGRESS_INTERVAL_MS: int = Field(2000, alias='PROGRESS_INTERVAL_MS')  # minimum time between two progress events of a pipeline call
+    PROGRESS_LOG: bool = Field(True, alias='PROGRESS_LOG')
+    PROGRESS_EXCHANGE: str = Field("", alias='PROGRESS_EXCHANGE')  # topic exchange progress events are published to, routed by job id. Empty disables publishing
+    PROGRESS_HISTORY_STEPS: int = Field(1000, alias='PROGRESS_HISTORY_STEPS')  # step durations kept in memory
+
+    IMAGE_ENCODE_WORKERS: int = Field(4, alias='IMAGE_ENCODE_WORKERS')
+    OUTPUT_FORMAT: str = Field("png", alias='OUTPUT_FORMAT')  # png, webp, avif or jpeg, for jobs that do not specify one
+    OUTPUT_QUALITY: int = Field(90, alias='OUTPUT_QUALITY')  # 1 to 100, for lossy formats of jobs that do not specify one
+    PNG_COMPRESS_LEVEL: int = Field(6, alias='PNG_COMPRESS_LEVEL')  # 0 (fastest, largest) to 9 (slowest, smallest)
+
+    UPLOAD_WORKERS: int = Field(8, alias='UPLOAD_WORKERS')
+    UPLOAD_RETRIES: int = Field(3, alias='UPLOAD_RETRIES')
+    UPLOAD_RETRY_BACKOFF_MS: int = Field(250, alias='UPLOAD_RETRY_BACKOFF_MS')
+
 
     class Config:
         env_file = '.env'  # Optionally load variables from a .env file
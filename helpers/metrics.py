@@ -0,0 +1,242 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from helpers.logger import logger
+
+# Minimal Prometheus-style metrics. Recording is an in-memory update, gauges backed by a callback are only evaluated
+# when /metrics is scraped, so the registry costs next to nothing while nobody is scraping.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.create_child())
+        return child
+
+    def create_child(self):
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for values, child in list(self.children.items()):
+            lines.extend(child.render(self.name, format_labels(self.labelnames, values)))
+        return lines
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def render(self, name: str, labels: str) -> list[str]:
+        return [f"{name}{labels} {format_value(self.value)}"]
+
+class Counter(Metric):
+    type = "counter"
+
+    def create_child(self):
+        return CounterValue()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+class GaugeValue:
+    def __init__(self, callback: Optional[Callable[[], float]] = None):
+        self.value = 0
+        self.callback = callback
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self, name: str, labels: str) -> list[str]:
+        value = self.value
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception as e:
+                logger.debug(f"Failed to evaluate gauge {name}: {e}")
+                return []
+        return [f"{name}{labels} {format_value(value)}"]
+
+# A gauge is either set explicitly or backed by a callback evaluated on every scrape
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), callback: Optional[Callable[[], float]] = None):
+        super().__init__(name, help, labelnames)
+        if callback is not None:
+            self.children[()] = GaugeValue(callback)
+
+    def create_child(self):
+        return GaugeValue()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_callback(self, callback: Callable[[], float], *values):
+        self.labels(*values).callback = callback
+
+class HistogramValue:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self, name: str, labels: str) -> list[str]:
+        label_prefix = labels[1:-1] + "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else format_value(bound)
+            lines.append(f'{name}_bucket{{{label_prefix}le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum{labels} {format_value(self.sum)}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def create_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.lock = threading.Lock()
+        self.collectors: list[Callable[[], list[tuple[str, str]]]] = []  # (labels, exposition text) of other processes, e.g. workers
+
+    # Return the metric registered under the name, registering it first if needed
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    # The metrics of this process and of the collectors share families (e.g. stage_duration_seconds), so they are merged
+    # into one exposition: a second TYPE line for the same name would make Prometheus reject the whole scrape
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        expositions = [("", "\n".join(lines))]
+        for collector in self.collectors:
+            try:
+                expositions.extend(collector())
+            except Exception as e:
+                logger.warning(f"Failed to collect metrics: {e}")
+        return merge_expositions(expositions)
+
+registry = MetricsRegistry()
+
+def add_labels(sample: str, labels: str) -> str:
+    if not labels:
+        return sample
+    name, value = sample.rsplit(" ", 1)
+    if "{" in name:
+        name, existing = name.split("{", 1)
+        return f"{name}{{{labels},{existing} {value}"
+    return f"{name}{{{labels}}} {value}"
+
+# Merge the exposition text of several processes, adding the given labels to every sample of a process. Each metric family
+# is written once with the first HELP and TYPE line seen for it and all of its samples, families without samples are left out.
+def merge_expositions(expositions: list[tuple[str, str]]) -> str:
+    families = {}
+    for labels, exposition in expositions:
+        family = None
+        for line in exposition.splitlines():
+            if line.startswith("# "):
+                parts = line.split(" ", 3)
+                if len(parts) < 3 or parts[1] not in ("HELP", "TYPE"):
+                    continue
+                family = families.setdefault(parts[2], {"HELP": None, "TYPE": None, "samples": []})
+                family[parts[1]] = family[parts[1]] or line
+            elif line and family is not None:
+                family["samples"].append(add_labels(line, labels))
+
+    lines = []
+    for family in families.values():
+        if family["samples"]:
+            lines.extend(line for line in (family["HELP"], family["TYPE"]) if line)
+            lines.extend(family["samples"])
+    return "\n".join(lines) + "\n" if lines else ""
+
+def counter(name: str, help: str, labelnames: tuple = ()) -> Counter:
+    return registry.register(Counter(name, help, labelnames))
+
+def gauge(name: str, help: str, labelnames: tuple = (), callback: Optional[Callable[[], float]] = None) -> Gauge:
+    return registry.register(Gauge(name, help, labelnames, callback))
+
+def histogram(name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, help, labelnames, buckets))
+
+stage_duration = histogram("stage_duration_seconds", "Duration of the job processing stages", ("stage",))
+
+# Stages are timed through helpers.timing, which also records them into the timings of the job
+def observe_stage_duration(stage: str, seconds: float):
+    stage_duration.labels(stage).observe(seconds)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serve /metrics on a background thread. Port 0 disables the endpoint.
+def start_metrics_server(port: int):
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on port {port} at /metrics")
+    return server
@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, asdict
+from functools import partial
+from typing import Callable, Optional
+from helpers.load_config import load_config
+from helpers.logger import logger
+from helpers.metrics import gauge
+
+config = load_config()
+
+@dataclass
+class ProgressEvent:
+    job_ids: list[str]
+    step: int
+    total_steps: int
+    elapsed_ms: float
+    step_ms: float  # duration of the latest step
+
+    def json(self) -> dict:
+        return asdict(self)
+
+# Step durations (ms) of the latest denoising steps of this process, oldest first
+step_history: deque = deque(maxlen=config.PROGRESS_HISTORY_STEPS)
+step_history_lock = threading.Lock()
+
+# Called with every emitted progress event, e.g. to publish it to RabbitMQ. Must not block.
+progress_listeners: list[Callable[[ProgressEvent], None]] = []
+
+def get_percentile(sorted_values: list[float], percentile: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(percentile / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+# Summary of step durations attached to the execution metadata of a job
+def get_step_percentiles(step_durations: list[float]) -> Optional[dict]:
+    if not step_durations:
+        return None
+    sorted_durations = sorted(step_durations)
+    return {
+        "steps": len(sorted_durations),
+        "p50_ms": round(get_percentile(sorted_durations, 50), 1),
+        "p90_ms": round(get_percentile(sorted_durations, 90), 1),
+        "p99_ms": round(get_percentile(sorted_durations, 99), 1),
+        "max_ms": round(sorted_durations[-1], 1),
+    }
+
+# Percentile of the latest step durations of this process, exported as a gauge evaluated on every scrape
+def get_recent_step_percentile(percentile: float) -> float:
+    with step_history_lock:
+        sorted_durations = sorted(step_history)
+    if not sorted_durations:
+        raise ValueError("no denoising steps recorded yet")  # leaves the sample out of the scrape
+    return get_percentile(sorted_durations, percentile)
+
+recent_step_duration = gauge("denoise_step_recent_milliseconds", "Percentiles of the latest PROGRESS_HISTORY_STEPS denoising step durations", ("quantile",))
+for quantile in (0.5, 0.9, 0.99):
+    recent_step_duration.set_callback(partial(get_recent_step_percentile, quantile * 100), quantile)
+
+# Records the wall time of every denoising step of one pipeline call. Progress is emitted at most once per
+# PROGRESS_INTERVAL_MS and on the last step, so the denoising loop never waits for log or network I/O on every step.
+class ProgressTracker:
+    def __init__(self, total_steps: int, job_ids: list[str]):
+        self.total_steps = total_steps
+        self.job_ids = job_ids
+        self.step_durations: list[float] = []
+        self.start_time = time.perf_counter()
+        self.last_step_time = self.start_time
+        self.last_emit_time = self.start_time
+
+    def on_step(self, step: int):
+        now = time.perf_counter()
+        step_ms = (now - self.last_step_time) * 1000
+        self.last_step_time = now
+        self.step_durations.append(step_ms)
+        with step_history_lock:
+            step_history.append(step_ms)
+
+        if (now - self.last_emit_time) * 1000 >= config.PROGRESS_INTERVAL_MS or step + 1 == self.total_steps:
+            self.last_emit_time = now
+            self.emit(ProgressEvent(
+                job_ids=self.job_ids,
+                step=step + 1,
+                total_steps=self.total_steps,
+                elapsed_ms=round((now - self.start_time) * 1000, 1),
+                step_ms=round(step_ms, 1)
+            ))
+
+    def emit(self, event: ProgressEvent):
+        if config.PROGRESS_LOG:
+            logger.info(f"Step {event.step}/{event.total_steps} ({event.step_ms:.0f}ms/step) for job(s): {event.job_ids}")
+        for listener in progress_listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logger.warning(f"Failed to emit progress: {e}")
+
+    # Callback for the pipeline's callback_on_step_end
+    def callback(self, pipeline, step: int, timestep, callback_kwargs: dict) -> dict:
+        self.on_step(step)
+        return callback_kwargs
@@ -0,0 +1,61 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+from helpers.metrics import observe_stage_duration
+
+# Per-job breakdown of the processing stages (validate, moderation, plugin load, denoise, upload, ...).
+# A stage is recorded into the stage histogram and into the timings of every job of the current context.
+# Nested stages are exclusive: validation does not count the moderation it waits for.
+
+class JobTimings:
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.stages: dict[str, float] = {}  # stage -> milliseconds, in the order the stages first ran
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds * 1000
+
+    # Stored in execution_metadata.timings. total_ms is the wall time since the job was delivered,
+    # the stages do not add up to it since waiting for the GPU or a post-processing worker is not a stage.
+    def json(self) -> dict:
+        with self.lock:
+            timings = {f"{stage}_ms": round(ms, 1) for stage, ms in self.stages.items()}
+        timings["total_ms"] = round((time.perf_counter() - self.start_time) * 1000, 1)
+        return timings
+
+_currentTimings: ContextVar[tuple] = ContextVar("job_timings", default=())
+_openStage: ContextVar[Optional[list]] = ContextVar("open_stage", default=None)
+
+# Record the stages run within the block into the given jobs. Jobs batched into one pipeline call share its stages.
+# Context variables do not cross threads, every thread working on a job has to enter the context itself.
+@contextmanager
+def job_timing(*timings: JobTimings):
+    token = _currentTimings.set(tuple(timings))
+    try:
+        yield
+    finally:
+        _currentTimings.reset(token)
+
+def observe_stage(stage: str, seconds: float):
+    observe_stage_duration(stage, seconds)
+    for timings in _currentTimings.get():
+        timings.add(stage, seconds)
+
+@contextmanager
+def time_stage(stage: str):
+    parent = _openStage.get()
+    nested = [0.0]  # seconds spent in stages nested into this one
+    token = _openStage.set(nested)
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        _openStage.reset(token)
+        if parent is not None:
+            parent[0] += elapsed
+        observe_stage(stage, elapsed - nested[0])
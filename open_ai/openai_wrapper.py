@@ -1,8 +1,16 @@
+import hashlib
 import sys
-from openai.types import Moderation
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from openai.types.moderation import Categories
 from helpers.load_config import load_config
 from openai import OpenAI
 from helpers.logger import logger
+from helpers.metrics import gauge
 
 config = load_config()
 _openai: OpenAI = None
@@ -20,12 +28,137 @@ def get_openai():
             sys.exit(1)
     return _openai
 
-def openai_moderate(prompt: str) -> Moderation:
+@dataclass
+class ModerationStats:
+    hits: int = 0
+    misses: int = 0
+    requests: int = 0
+    request_ms_total: float = 0
+    saved_ms_total: float = 0  # estimated from the average request latency
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def request_ms_avg(self) -> float:
+        return self.request_ms_total / self.requests if self.requests else 0
+
+# LRU cache with a time to live, mapping normalized prompt hashes to the moderation categories of the prompt
+class ModerationCache:
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, Categories]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = ModerationStats()
+
+    def get(self, key: str, record_miss: bool = True):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                if record_miss:
+                    self.stats.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            self.stats.saved_ms_total += self.stats.request_ms_avg()
+            return entry[1]
+
+    def put(self, key: str, categories: Categories):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, categories)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def record_request(self, duration_ms: float):
+        with self.lock:
+            self.stats.requests += 1
+            self.stats.request_ms_total += duration_ms
+
+moderation_cache = ModerationCache(config.MODERATION_CACHE_SIZE, config.MODERATION_CACHE_TTL)
+gauge("moderation_cache_hit_ratio", "Share of moderation lookups served from the cache", callback=lambda: moderation_cache.stats.hit_rate())
+
+# Prompts differing only in unicode representation, case or whitespace share a cache entry
+def get_moderation_key(prompt: str) -> str:
+    normalized = " ".join(unicodedata.normalize("NFKC", prompt).casefold().split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+# Moderate many prompts, sending the ones missing from the cache in as few requests as possible
+def openai_moderate_batch(prompts: list[str]) -> list[Categories]:
+    keys = [get_moderation_key(prompt) for prompt in prompts]
+    results = {key: moderation_cache.get(key) for key in set(keys)}
+    missing = {key: prompt for key, prompt in zip(keys, prompts) if results[key] is None}
+
     openai = get_openai()
-    try:
-        response = openai.moderations.create(input=prompt)
-        results = response.results[0]
-        return results
-    except Exception as e:
-        logger.error(f"Failed to request moderation from OpenAI, error: {e}")
-        raise Exception("Endpoint connection not possible")
\ No newline at end of file
+    missing_items = list(missing.items())
+    for i in range(0, len(missing_items), config.MODERATION_BATCH_SIZE):
+        chunk = missing_items[i:i + config.MODERATION_BATCH_SIZE]
+        try:
+            start_time = time.monotonic()
+            response = openai.moderations.create(input=[prompt for _, prompt in chunk])
+            moderation_cache.record_request((time.monotonic() - start_time) * 1000)
+        except Exception as e:
+            logger.error(f"Failed to request moderation from OpenAI, error: {e}")
+            raise Exception("Endpoint connection not possible")
+
+        for (key, _), result in zip(chunk, response.results):
+            moderation_cache.put(key, result.categories)
+            results[key] = result.categories
+
+    if missing:
+        stats = moderation_cache.stats
+        logger.info(f"Moderated {len(missing)} prompt(s) with OpenAI (cache hit rate: {stats.hit_rate():.0%}, saved: {stats.saved_ms_total / 1000:.1f}s)")
+    return [results[key] for key in keys]
+
+# Collects prompts moderated concurrently (e.g. by the admission workers of prefetched jobs) into shared requests
+class ModerationBatcher:
+    def __init__(self, window_ms: int, max_batch: int):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending: list[tuple[str, Future]] = []
+        self.lock = threading.Lock()
+
+    def moderate(self, prompt: str) -> Categories:
+        future = Future()
+        batch = None
+        with self.lock:
+            self.pending.append((prompt, future))
+            if len(self.pending) >= self.max_batch:
+                batch, self.pending = self.pending, []
+            elif len(self.pending) == 1:
+                timer = threading.Timer(self.window, self.flush)
+                timer.daemon = True
+                timer.start()
+
+        if batch:
+            self.run(batch)
+        return future.result()
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            self.run(batch)
+
+    def run(self, batch: list[tuple[str, Future]]):
+        try:
+            results = openai_moderate_batch([prompt for prompt, _ in batch])
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+
+moderation_batcher = ModerationBatcher(config.MODERATION_BATCH_WINDOW_MS, config.MODERATION_BATCH_SIZE)
+
+def openai_moderate(prompt: str) -> Categories:
+    # Misses are counted once the prompt is looked up again by openai_moderate_batch
+    cached = moderation_cache.get(get_moderation_key(prompt), record_miss=False)
+    if cached is not None:
+        return cached
+
+    if config.MODERATION_BATCH_WINDOW_MS > 0:
+        return moderation_batcher.moderate(prompt)
+    return openai_moderate_batch([prompt])[0]
@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from data_types.types import SupabaseJobQueueType, JobStatus, TextToImageRequestType
+from helpers.load_config import load_config
+from helpers.logger import logger
+from helpers.timing import JobTimings, job_timing, observe_stage, time_stage
+from rabbitmq.rabbitmq_jobs import get_task_id, validate_job, fail_job
+from rabbitmq.rabbitmq_results import update_job_status
+from stable_diffusion.plugin_registry import get_plugin_registry
+
+config = load_config()
+
+@dataclass
+class AdmittedJob:
+    delivery_tag: str
+    task_data: SupabaseJobQueueType
+    request_data: TextToImageRequestType
+    start_time: datetime
+    timings: JobTimings
+
+# Decode, validate and moderate a message and fetch its plugins so the job is ready to run on the GPU
+def admit_job(body, timings: JobTimings) -> tuple[SupabaseJobQueueType, TextToImageRequestType]:
+    with job_timing(timings):
+        task_data = SupabaseJobQueueType.from_json(json.loads(body.decode('utf-8')))
+        if task_data.created_at is not None:
+            observe_stage("queue_wait", (datetime.now(task_data.created_at.tzinfo) - task_data.created_at).total_seconds())
+        update_job_status(task_data.id, JobStatus.RUNNING, {"started_at": datetime.now().isoformat()})
+        logger.info(f"Admitting Job {task_data.id}")
+
+        with time_stage("validate"):
+            request_data = validate_job(task_data)
+
+        # Make sure the plugins are cached locally, so the GPU thread never waits for a download
+        with time_stage("plugin_fetch"):
+            for plugin in request_data.plugins or []:
+                get_plugin_registry().get_plugin_path(plugin.id)
+
+        return task_data, request_data
+
+# Runs the admission work of prefetched messages on worker threads while the GPU is busy with the current job
+class AdmissionStage:
+    def __init__(self, channel, workers: int = config.CONSUMER_ADMISSION_WORKERS):
+        self.channel = channel
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="admission")
+        self.pending = deque()
+        self.condition = threading.Condition()
+
+    # Called on the RabbitMQ I/O thread for every delivered message
+    def on_message(self, delivery_tag, body):
+        start_time = datetime.now()
+        timings = JobTimings()
+        future = self.executor.submit(admit_job, body, timings)
+        with self.condition:
+            self.pending.append((delivery_tag, body, start_time, timings, future))
+        future.add_done_callback(self.on_admitted)
+
+    # Wake up the GPU thread as soon as a job is admitted
+    def on_admitted(self, _future):
+        with self.condition:
+            self.condition.notify_all()
+
+    # Wait up to timeout seconds for admitted jobs and take up to max_jobs of them in delivery order.
+    # Jobs that failed admission are rejected right away.
+    def wait_ready(self, max_jobs: int, timeout: float) -> list[AdmittedJob]:
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                done = [entry for entry in self.pending if entry[4].done()][:max_jobs]
+                remaining = deadline - time.monotonic()
+                if done or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            for entry in done:
+                self.pending.remove(entry)
+
+        ready = []
+        for delivery_tag, body, start_time, timings, future in done:
+            try:
+                task_data, request_data = future.result()
+                ready.append(AdmittedJob(delivery_tag=delivery_tag, task_data=task_data, request_data=request_data, start_time=start_time, timings=timings))
+            except Exception as e:
+                fail_job(self.channel, delivery_tag, get_task_id(body), start_time, e, timings)
+
+        return ready
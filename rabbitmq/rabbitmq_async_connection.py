@@ -0,0 +1,253 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable, Optional
+
+import pika
+from pika.adapters.select_connection import IOLoop, SelectConnection
+
+from helpers.logger import logger
+from rabbitmq.rabbitmq_connection import get_connection_parameters, RECONNECT_DELAY
+
+SETTLED_HISTORY_SIZE = 1000  # settled messages remembered to recognise redeliveries after a reconnect
+
+@dataclass
+class Subscription:
+    queue: str
+    prefetch_count: int
+    on_message: Callable[[str, bytes], None]  # called on the I/O thread with the delivery key and the body
+
+# Asynchronous RabbitMQ connection whose I/O loop runs on its own thread, so heartbeats are served while the GPU is busy.
+# Messages are identified by a delivery key (the message_id) and can be settled from any thread. Messages stay in flight
+# across reconnects: a redelivery of a message that is still being processed is not passed on again, and it is settled
+# on the new channel once the job finishes.
+# With confirm_delivery, every publish returns a future resolved with the confirm latency in seconds once the broker
+# confirmed the message, or failed if the broker nacked it or the channel was lost.
+class AsyncRabbitMQ:
+    def __init__(self, confirm_delivery: bool = False):
+        self.confirm_delivery = confirm_delivery
+        self.ioloop = IOLoop()
+        self.connection: Optional[SelectConnection] = None
+        self.channel = None
+        self.channel_number = 0
+        self.subscriptions: list[Subscription] = []
+        self.declarations: list[str] = []  # queues this connection publishes to
+        self.exchange_declarations: list[tuple[str, str]] = []  # (exchange, type) this connection publishes to
+        self.inflight: dict[str, Optional[int]] = {}  # delivery key -> delivery tag, None while its channel is lost
+        self.settled: OrderedDict[str, bool] = OrderedDict()  # recently settled delivery keys -> acknowledged
+        self.publish_sequence = 0
+        self.unconfirmed: OrderedDict[int, tuple[Future, float]] = OrderedDict()  # publish sequence number -> (future, publish time)
+        self.ready = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="rabbitmq-io", daemon=True)
+
+    # Register a queue to consume from. Must be called before start().
+    def consume(self, queue: str, prefetch_count: int, on_message: Callable[[str, bytes], None]):
+        self.subscriptions.append(Subscription(queue=queue, prefetch_count=prefetch_count, on_message=on_message))
+
+    # Register a durable queue to declare, so messages published to it are never unroutable. Must be called before start().
+    def declare(self, queue: str):
+        self.declarations.append(queue)
+
+    # Register a durable exchange to declare. Must be called before start().
+    def declare_exchange(self, exchange: str, exchange_type: str):
+        self.exchange_declarations.append((exchange, exchange_type))
+
+    # Start the I/O thread and wait until all subscriptions are set up
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self):
+        self.stopping = True
+        self.call_threadsafe(self.close)
+
+    def run(self):
+        self.connect()
+        self.ioloop.start()
+
+    # Schedule a callback on the I/O thread
+    def call_threadsafe(self, callback: Callable[[], None]):
+        self.ioloop.add_callback_threadsafe(callback)
+
+    # Publish a message from any thread
+    def publish(self, routing_key: str, body: str, properties: pika.BasicProperties = None, exchange: str = '') -> Future:
+        future = Future()
+        self.call_threadsafe(partial(self.basic_publish, exchange, routing_key, body, properties, future))
+        return future
+
+    def basic_ack(self, delivery_tag: str):
+        self.call_threadsafe(partial(self.settle, delivery_tag, True))
+
+    def basic_nack(self, delivery_tag: str, requeue=False):
+        self.call_threadsafe(partial(self.settle, delivery_tag, False, requeue))
+
+    def connect(self):
+        logger.info("Connecting to RabbitMQ...")
+        self.connection = SelectConnection(
+            parameters=get_connection_parameters(),
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error,
+            on_close_callback=self.on_connection_closed,
+            custom_ioloop=self.ioloop
+        )
+
+    def close(self):
+        if self.connection and not (self.connection.is_closing or self.connection.is_closed):
+            self.connection.close()
+        else:
+            self.ioloop.stop()
+
+    def reconnect_later(self):
+        if self.stopping:
+            self.ioloop.stop()
+            return
+        logger.info(f"Reconnecting to RabbitMQ in {RECONNECT_DELAY} seconds, {len(self.inflight)} job(s) still in flight")
+        self.ioloop.call_later(RECONNECT_DELAY, self.connect)
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_open_error(self, connection, error):
+        logger.error(f"Connection error: {error}")
+        self.reconnect_later()
+
+    def on_connection_closed(self, connection, reason):
+        logger.warning(f"RabbitMQ connection closed: {reason}")
+        self.channel = None
+        self.ready.clear()
+        self.fail_unconfirmed(f"RabbitMQ connection closed: {reason}")
+        # Delivery tags are bound to their channel, in-flight messages are settled once they are redelivered
+        for key in self.inflight:
+            self.inflight[key] = None
+        self.reconnect_later()
+
+    def on_channel_open(self, channel):
+        self.channel = channel
+        self.channel_number += 1
+        channel.add_on_close_callback(self.on_channel_closed)
+
+        if self.confirm_delivery:
+            self.publish_sequence = 0
+            channel.confirm_delivery(self.on_delivery_confirmation, callback=lambda _frame: self.declare_queue(0))
+        else:
+            self.declare_queue(0)
+
+    def on_channel_closed(self, channel, reason):
+        logger.warning(f"RabbitMQ channel closed: {reason}")
+        # Reconnect from scratch, the connection close callback takes care of it
+        if self.connection and not (self.connection.is_closing or self.connection.is_closed):
+            self.connection.close()
+
+    # Declare the queues one after another, then the exchanges, then set up the subscriptions
+    def declare_queue(self, index: int):
+        if index == len(self.declarations):
+            self.declare_exchange_on_channel(0)
+            return
+        self.channel.queue_declare(queue=self.declarations[index], durable=True, callback=lambda _frame: self.declare_queue(index + 1))
+
+    def declare_exchange_on_channel(self, index: int):
+        if index == len(self.exchange_declarations):
+            self.setup_subscription(0)
+            return
+        exchange, exchange_type = self.exchange_declarations[index]
+        self.channel.exchange_declare(exchange=exchange, exchange_type=exchange_type, durable=True, callback=lambda _frame: self.declare_exchange_on_channel(index + 1))
+
+    # Declare, limit and consume the subscriptions one after another
+    def setup_subscription(self, index: int):
+        if index == len(self.subscriptions):
+            logger.info(f"Connected to RabbitMQ, consuming from: {[s.queue for s in self.subscriptions]}")
+            self.ready.set()
+            return
+
+        subscription = self.subscriptions[index]
+        channel = self.channel
+
+        def on_qos_ok(_frame):
+            channel.basic_consume(subscription.queue, partial(self.on_delivery, subscription), auto_ack=False)
+            self.setup_subscription(index + 1)
+
+        def on_queue_declared(_frame):
+            channel.basic_qos(prefetch_count=subscription.prefetch_count, callback=on_qos_ok)
+
+        channel.queue_declare(queue=subscription.queue, durable=True, callback=on_queue_declared)
+
+    def on_delivery(self, subscription: Subscription, channel, method, properties, body):
+        key = properties.message_id or f"{self.channel_number}-{method.delivery_tag}"
+
+        if key in self.settled:
+            logger.info(f"{key} - Redelivered message was already processed, settling it again")
+            self.settle_tag(method.delivery_tag, self.settled[key])
+            return
+
+        if key in self.inflight:
+            logger.info(f"{key} - Redelivered message is still being processed")
+            self.inflight[key] = method.delivery_tag
+            return
+
+        self.inflight[key] = method.delivery_tag
+        subscription.on_message(key, body)
+
+    def settle(self, key: str, ack: bool, requeue=False):
+        delivery_tag = self.inflight.pop(key, None)
+        if not requeue:
+            self.settled[key] = ack
+            while len(self.settled) > SETTLED_HISTORY_SIZE:
+                self.settled.popitem(last=False)
+
+        if delivery_tag is None:
+            logger.warning(f"{key} - Channel was lost, message will be settled when it is redelivered")
+            return
+        self.settle_tag(delivery_tag, ack, requeue)
+
+    def settle_tag(self, delivery_tag: int, ack: bool, requeue=False):
+        if self.channel is None or not self.channel.is_open:
+            return
+        if ack:
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+        else:
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+
+    def basic_publish(self, exchange: str, routing_key: str, body: str, properties: pika.BasicProperties, future: Future):
+        if self.channel is None or not self.channel.is_open:
+            future.set_exception(Exception("RabbitMQ channel is not open"))
+            return
+
+        try:
+            self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+        except Exception as e:
+            future.set_exception(e)
+            return
+
+        if self.confirm_delivery:
+            self.publish_sequence += 1
+            self.unconfirmed[self.publish_sequence] = (future, time.monotonic())
+        else:
+            future.set_result(None)
+
+    def on_delivery_confirmation(self, frame):
+        confirmation = frame.method.NAME.split('.')[1].lower()
+        delivery_tag = frame.method.delivery_tag
+        if frame.method.multiple:
+            sequence_numbers = [tag for tag in self.unconfirmed if tag <= delivery_tag]
+        else:
+            sequence_numbers = [delivery_tag]
+
+        now = time.monotonic()
+        for sequence_number in sequence_numbers:
+            future, published_at = self.unconfirmed.pop(sequence_number, (None, None))
+            if future is None or future.done():
+                continue
+            if confirmation == 'ack':
+                future.set_result(now - published_at)
+            else:
+                future.set_exception(Exception("Message was nacked by RabbitMQ"))
+
+    def fail_unconfirmed(self, reason: str):
+        for future, _ in self.unconfirmed.values():
+            if not future.done():
+                future.set_exception(Exception(reason))
+        self.unconfirmed.clear()
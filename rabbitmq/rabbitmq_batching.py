@@ -0,0 +1,47 @@
+from collections import defaultdict
+from helpers.logger import logger
+from helpers.timing import job_timing
+from rabbitmq.rabbitmq_admission import AdmittedJob
+from rabbitmq.rabbitmq_jobs import fail_job
+from rabbitmq.rabbitmq_postprocessor import PostProcessor
+from stable_diffusion.stable_diffusion_manager import get_stable_diffusion
+
+# Generate every group of compatible jobs in one pipeline call
+def process_jobs(ch, jobs: list[AdmittedJob], postprocessor: PostProcessor):
+    logger.info(f"Processing batch of {len(jobs)} job(s)")
+    stable_diffusion = get_stable_diffusion()
+
+    groups = defaultdict(list)
+    for job in jobs:
+        groups[stable_diffusion.get_batch_key(job.request_data)].append(job)
+
+    for group in groups.values():
+        process_batch_group(ch, group, postprocessor)
+
+# Generate all images of a group of jobs sharing the same batch key, then hand every job to post-processing individually
+def process_batch_group(ch, jobs: list[AdmittedJob], postprocessor: PostProcessor):
+    stable_diffusion = get_stable_diffusion()
+
+    samples = []
+    sample_jobs = []
+    for job in jobs:
+        options = stable_diffusion.get_option_requests(job.request_data)
+        samples.extend(options)
+        sample_jobs.extend([job] * len(options))
+
+    # All options of all jobs go into a single call, text_to_image_batch splits them into as few passes as fit into memory.
+    # Every job is charged the full duration of the GPU stages it shared.
+    try:
+        with job_timing(*[job.timings for job in jobs]):
+            executions = stable_diffusion.text_to_image_batch(samples, encode=False, job_ids=[job.task_data.id for job in sample_jobs])
+    except Exception as e:
+        for job in jobs:
+            fail_job(ch, job.delivery_tag, job.task_data.id, job.start_time, Exception(f"Image generation failed: {e}"), job.timings)
+        return
+
+    offset = 0
+    for job in jobs:
+        job_executions = executions[offset:offset + job.request_data.num_options]
+        offset += job.request_data.num_options
+
+        postprocessor.submit(job.delivery_tag, job.task_data, job_executions, job.start_time, job.timings)
@@ -13,6 +13,20 @@ config = load_config()
 _rabbitmq: Optional[tuple[BlockingConnection, BlockingChannel]] = None
 RECONNECT_DELAY = 5  # seconds
 
+# Connection parameters shared by the blocking and the asynchronous connection
+def get_connection_parameters() -> pika.ConnectionParameters:
+    # Set up RabbitMQ connection with username and password credentials
+    credentials = pika.PlainCredentials(
+        username=config.RABBITMQ_DEFAULT_USER,
+        password=config.RABBITMQ_DEFAULT_PASS
+    )
+    return pika.ConnectionParameters(
+        host=config.RABBITMQ_HOST,
+        credentials=credentials,
+        heartbeat=60,
+        blocked_connection_timeout=300
+    )
+
 # Universal function for RabbitMQ setup
 def get_rabbitmq() -> tuple[BlockingConnection, BlockingChannel]:
     global _rabbitmq
@@ -23,19 +37,7 @@ def get_rabbitmq() -> tuple[BlockingConnection, BlockingChannel]:
         try:
             logger.info("Connecting to RabbitMQ...")
 
-            # Set up RabbitMQ connection with username and password credentials
-            credentials = pika.PlainCredentials(
-                username=config.RABBITMQ_DEFAULT_USER,
-                password=config.RABBITMQ_DEFAULT_PASS
-            )
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(
-                    host=config.RABBITMQ_HOST,
-                    credentials=credentials,
-                    heartbeat=60,
-                    blocked_connection_timeout=300
-                )
-            )
+            connection = pika.BlockingConnection(get_connection_parameters())
             channel = connection.channel()
             channel.queue_declare(queue=config.RABBITMQ_QUEUE, durable=True)
 
@@ -1,71 +1,64 @@
-import json
-from datetime import datetime
-from data_types.types import SupabaseJobQueueType, JobStatus, JobType
-from generate.text_to_image import text_to_image
-from generate.text_to_portrait import text_to_portrait
-from helpers.execution_metadata import create_execution_metadata
+import time
 from helpers.load_config import load_config
 from helpers.logger import logger
-from rabbitmq.rabbitmq_connection import get_rabbitmq
-from supabase_helpers.supabase_images import create_supabase_image_entities
-from supabase_helpers.supabase_job_queue import update_supabase_job_queue
+from helpers.metrics import gauge
+from helpers.progress import progress_listeners
+from rabbitmq.rabbitmq_admission import AdmissionStage
+from rabbitmq.rabbitmq_async_connection import AsyncRabbitMQ
+from rabbitmq.rabbitmq_batching import process_jobs
+from rabbitmq.rabbitmq_postprocessor import PostProcessor
+from rabbitmq.rabbitmq_progress import get_progress_publisher, publish_progress
+from rabbitmq.rabbitmq_results import get_results_publisher
 
 config = load_config()
 
-# Subscribe to RabbitMQ and consume messages from the queue
+# Subscribe to RabbitMQ and consume messages from the queue. The connection runs on its own I/O thread,
+# the GPU work runs on the calling thread.
 def subscribe_to_rabbitmq():
-    connection, channel = get_rabbitmq()
-    channel.basic_consume(
-        queue=config.RABBITMQ_QUEUE,
-        on_message_callback=consume_queue,
-        auto_ack=False  # set to False for manual ack to handle failures properly
-    )
-    channel.start_consuming()
-    logger.info("Started consuming messages from the queue.")
+    rabbitmq = AsyncRabbitMQ()
+    if config.JOB_STATUS_WRITER:
+        logger.info(f"Publishing job status updates to: {config.RABBITMQ_RESULTS_QUEUE}")
+        get_results_publisher()
+
+    if config.PROGRESS_EXCHANGE:
+        logger.info(f"Publishing progress events to: {config.PROGRESS_EXCHANGE}")
+        get_progress_publisher()
+        progress_listeners.append(publish_progress)
 
-# Callback function to process messages from the queue.
-def consume_queue(ch, method, properties, body):
-    start_time = datetime.now()
-    try:
-        # Process the messages
-        decoded_body = body.decode('utf-8')
-        process_message(decoded_body)
+    # Prefetched messages are admitted (validated, moderated) on worker threads while the GPU is busy
+    admission = AdmissionStage(rabbitmq)
 
-        # Acknowledge the message only after successful processing
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-    except Exception as e:
-        task_id = json.loads(decoded_body).get('id')
-        logger.exception(f"Failed to process task {task_id}, error: {e}")
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+    # Finished jobs are stored and acknowledged in the background while the next job is generated
+    postprocessor = PostProcessor(rabbitmq)
 
-        estimated_runtime = int((datetime.now() - start_time).total_seconds() * 1000) # Add rough execution time for debugging (it counts storage upload time as well, hence not accurate)
-        update_supabase_job_queue(task_id, JobStatus.FAILED, create_execution_metadata(estimated_runtime, {"error": str(e)}))
+    gauge("rabbitmq_inflight_messages", "Messages delivered to this worker and not settled yet", callback=lambda: len(rabbitmq.inflight))
+    gauge("postprocess_queue_depth", "Generated jobs waiting for post-processing", callback=lambda: postprocessor.queue.qsize())
+
+    rabbitmq.consume(
+        queue=config.RABBITMQ_QUEUE,
+        prefetch_count=max(config.RABBITMQ_PREFETCH_COUNT, config.CONSUMER_BATCH_SIZE),
+        on_message=admission.on_message
+    )
+    rabbitmq.start()
+    logger.info("Started consuming messages from the queue.")
+    if config.CONSUMER_BATCH_SIZE > 1:
+        logger.info(f"Batching up to {config.CONSUMER_BATCH_SIZE} jobs, waiting at most {config.CONSUMER_BATCH_MAX_WAIT_MS}ms")
 
-# Process the message body
-def process_message(body):
-    global executions
-    task_data = SupabaseJobQueueType.from_json(json.loads(body))
-    update_supabase_job_queue(task_data.id, JobStatus.RUNNING, {"started_at": datetime.now().isoformat()})
-    logger.info(f"Processing Job {task_data.id}")
+    consume_admitted_jobs(rabbitmq, admission, postprocessor)
 
-    # [1/3] Generate image
-    try:
-        if task_data.job_type == JobType.TEXT_TO_IMAGE:
-            executions = text_to_image(task_data)
-        elif task_data.job_type == JobType.TEXT_TO_PORTRAIT:
-            executions = text_to_portrait(task_data)
-        else:
-            raise Exception(f"invalid job type: {task_data.job_type}")
-    except Exception as e:
-        raise Exception(f"Image generation failed: {e}")
+# Feed admitted jobs to the GPU. A batch waits at most CONSUMER_BATCH_MAX_WAIT_MS for more jobs once its first job is ready.
+def consume_admitted_jobs(rabbitmq: AsyncRabbitMQ, admission: AdmissionStage, postprocessor: PostProcessor):
+    batch = []
+    batch_deadline = None
+    while True:
+        timeout = 1 if batch_deadline is None else max(0, batch_deadline - time.monotonic())
+        batch.extend(admission.wait_ready(config.CONSUMER_BATCH_SIZE - len(batch), timeout))
+        if not batch:
+            continue
 
-    if len(executions) != task_data.request_data.num_options:
-        raise Exception(f"Number of generated images ({len(executions)}) did not match the request ({task_data.request_data.num_options})")
+        if batch_deadline is None:
+            batch_deadline = time.monotonic() + config.CONSUMER_BATCH_MAX_WAIT_MS / 1000
 
-    # [3/3] Update database job_queue
-    try:
-        total_runtime = sum(execution.runtime for execution in executions)
-        execution_metadata = create_execution_metadata(total_runtime)
-        update_supabase_job_queue(task_data.id, JobStatus.SUCCEEDED, execution_metadata)
-    except Exception:
-        raise Exception(f"Database update failed")
+        if len(batch) >= config.CONSUMER_BATCH_SIZE or time.monotonic() >= batch_deadline:
+            process_jobs(rabbitmq, batch, postprocessor)
+            batch, batch_deadline = [], None
@@ -1,105 +1,187 @@
+import json
 import time
+from concurrent.futures import Future
 from datetime import datetime, timedelta, timezone
 from data_types.types import SupabaseJobQueueType, TextToImageRequestType, JobStatus, JobType
 from helpers.load_config import load_config
 from helpers.logger import logger
-from rabbitmq.rabbitmq_connection import get_rabbitmq
-from rabbitmq.rabbitmq_queue import get_queue_length, add_job_to_queue
-from supabase_helpers.supabase_connection import get_supabase_postgres
-from supabase_helpers.supabase_job_queue import update_supabase_job_queue
+from helpers.metrics import gauge, start_metrics_server
+from rabbitmq.rabbitmq_async_connection import AsyncRabbitMQ
+from rabbitmq.rabbitmq_connection import get_rabbitmq, RECONNECT_DELAY
+from rabbitmq.rabbitmq_queue import add_jobs_to_queue, collect_late_publish_results, get_queue_length
+from supabase_helpers.supabase_connection import get_supabase_postgres, get_supabase_postgres_pool
+from supabase_helpers.supabase_job_queue import revert_supabase_jobs_to_queued
+from supabase_helpers.supabase_listen import SupabaseListener
 
 config = load_config()
+JOB_QUEUE_NOTIFY_CHANNEL = "job_queue_inserted"  # see supabase/migrations/20261017000000_job_queue_notify.sql
+
+unpublished_jobs = gauge("filler_unpublished_jobs", "Jobs claimed from PostgreSQL that are not confirmed by RabbitMQ yet")
+pending_publishes: dict[Future, SupabaseJobQueueType] = {}  # publishes not confirmed within PUBLISH_CONFIRM_TIMEOUT_MS
 
 # Main function to subscribe to PostgreSQL notifications and send new rows to RabbitMQ
 def supabase_to_rabbitmq():
-    supabase_postgres = get_supabase_postgres()
     rabbit_conn, rabbit_channel = get_rabbitmq()
+    listener = SupabaseListener([JOB_QUEUE_NOTIFY_CHANNEL])
+
+    # Jobs are published on a separate connection in confirm mode, the blocking channel is used to read the queue length
+    publisher = AsyncRabbitMQ(confirm_delivery=True)
+    publisher.start()
+    start_metrics_server(config.METRICS_PORT)
 
     logger.info("Stopping jobs older than %s minutes", config.JOB_DISCARD_THRESHOLD)
 
     try:
         while True:
-            fetch_jobs_if_needed(supabase_postgres, rabbit_channel)
-            time.sleep(10)
+            revert_late_publish_failures()
+            backlog = fetch_jobs_if_needed(rabbit_channel, publisher)
+            wait_for_jobs(listener, rabbit_conn, rabbit_channel, backlog)
     finally:
-        supabase_postgres.close()
+        publisher.stop()
+        listener.close()
+        get_supabase_postgres_pool().closeall()
         rabbit_conn.close()
         logger.info("Supabase & RabbitMQ connections terminated.")
 
+# Put the jobs whose publish failed after timing out back into the queue, all in one statement
+def revert_late_publish_failures():
+    failed_jobs = collect_late_publish_results(pending_publishes)
+    if failed_jobs:
+        revert_supabase_jobs_to_queued([job.id for job in failed_jobs])
+    unpublished_jobs.set(len(pending_publishes))
+
+# Block until there is work to claim: a job was queued (NOTIFY), the RabbitMQ queue drained while jobs are
+# still waiting in PostgreSQL, or the safety net poll interval expired.
+def wait_for_jobs(listener: SupabaseListener, rabbit_conn, rabbit_channel, backlog: bool):
+    deadline = time.monotonic() + config.FILLER_POLL_INTERVAL
+    while True:
+        remaining = max(0, deadline - time.monotonic())
+        if remaining == 0:
+            return
+        if listener.wait(timeout=min(config.FILLER_DRAIN_CHECK_INTERVAL_MS / 1000, remaining)):
+            logger.debug("Woken up by job queue notification")
+            return
+
+        # Keep the blocking connection's heartbeats going while waiting
+        rabbit_conn.process_data_events(time_limit=0)
+
+        if pending_publishes:
+            revert_late_publish_failures()
+
+        if backlog:
+            queue_length = get_queue_length(rabbit_channel)
+            if queue_length is not None and queue_length < config.RABBITMQ_QUEUE_SIZE:
+                logger.debug("Woken up by drained RabbitMQ queue")
+                return
+
 # Validate job data before adding it to RabbitMQ
 def validate_supabase_job_data(job_data: SupabaseJobQueueType):
     try:
         created_at = job_data.created_at
         if created_at and ((datetime.now(timezone.utc) - created_at) > timedelta(minutes=config.JOB_DISCARD_THRESHOLD)):
-            update_supabase_job_queue(job_data.id, JobStatus.FAILED, {"error": "expired"})
             return False
         return True
     except Exception as e:
         logger.error(f"{job_data.id} - Job validation raised exception: {e}")
         return False
 
-# Fetch a job from the job_queue table in PostgreSQL.
-def fetch_job_from_supabase(conn) -> SupabaseJobQueueType:
-    cursor = conn.cursor()
+# Claim up to limit queued jobs from the job_queue table in PostgreSQL with a single statement.
+def fetch_jobs_from_supabase(limit: int) -> list[SupabaseJobQueueType]:
     try:
-        cursor.execute(
-            """
-            UPDATE job_queue
-            SET job_status = 'assigned',
-                execution_metadata = jsonb_set(
-                    COALESCE(execution_metadata, '{}'),
-                    '{node}',
-                    to_jsonb(%s::text),
-                    true
-                ) || jsonb_build_object('assigned_at', %s::text)
-            WHERE id = (
-                SELECT id FROM job_queue
-                WHERE job_status = 'queued'
-                ORDER BY created_at ASC 
-                FOR UPDATE SKIP LOCKED
-                LIMIT 1
+        with get_supabase_postgres() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE job_queue
+                SET job_status = 'assigned',
+                    execution_metadata = jsonb_set(
+                        COALESCE(execution_metadata, '{}'),
+                        '{node}',
+                        to_jsonb(%s::text),
+                        true
+                    ) || jsonb_build_object('assigned_at', %s::text)
+                WHERE id IN (
+                    SELECT id FROM job_queue
+                    WHERE job_status = 'queued'
+                    ORDER BY created_at ASC 
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT %s
+                )
+                RETURNING id, job_type, request_data, team, created_at;
+                """,
+                (config.NODE_ID, datetime.now().isoformat(), limit)
             )
-            RETURNING id, job_type, request_data, team, created_at;
-            """,
-            (config.NODE_ID, datetime.now().isoformat())
-        )
-        job = cursor.fetchone()
-        if job:
-            job_id, job_type, request_data, team, created_at = job
-            job_data = SupabaseJobQueueType(
+            rows = cursor.fetchall()
+
+        jobs = []
+        for job_id, job_type, request_data, team, created_at in rows:
+            jobs.append(SupabaseJobQueueType(
                 id=job_id,
                 request_data=TextToImageRequestType.from_json(request_data),
                 created_at=created_at,
                 job_status='assigned',
                 team=team,
                 job_type=JobType(job_type)
+            ))
+
+        # RETURNING does not preserve the order of the sub-select
+        jobs.sort(key=lambda job: job.created_at)
+        if jobs:
+            logger.info(f"Assigned {len(jobs)} job(s) to node {config.NODE_ID}: {[job.id for job in jobs]}")
+        return jobs
+    except Exception as e:
+        logger.error(f"Error fetching jobs from PostgreSQL: {e}")
+        return []
+
+# Mark all expired jobs as failed with a single statement
+def fail_expired_jobs(jobs: list[SupabaseJobQueueType]):
+    try:
+        with get_supabase_postgres() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                "UPDATE job_queue SET job_status = %s, execution_metadata = %s WHERE id IN %s;",
+                (JobStatus.FAILED.value, json.dumps({"error": "expired"}), tuple(job.id for job in jobs))
             )
-            logger.info(f"Assigned job {job_id} to node {config.NODE_ID}")
-            return job_data
-        return None
+        logger.info(f"Discarded {len(jobs)} expired job(s): {[job.id for job in jobs]}")
     except Exception as e:
-        logger.error(f"Error fetching job from PostgreSQL: {e}")
-        return None
-    finally:
-        cursor.close()
+        logger.error(f"Failed to discard expired jobs: {e}")
 
-# Fetch jobs if RabbitMQ queue is below the threshold
-def fetch_jobs_if_needed(conn, channel):
+# Fetch as many jobs as the RabbitMQ queue is below the threshold.
+# Returns whether queued jobs may be left in PostgreSQL because the RabbitMQ queue was full.
+def fetch_jobs_if_needed(channel, publisher: AsyncRabbitMQ) -> bool:
     try:
+        if not publisher.ready.is_set():
+            logger.warning("RabbitMQ publisher is not connected, not claiming any jobs")
+            return False
+
         queue_length = get_queue_length(channel)
         logger.info(f"Current RabbitMQ queue length: {queue_length}")
+        if queue_length is None:
+            return False
+        if queue_length >= config.RABBITMQ_QUEUE_SIZE:
+            return True
 
-        while queue_length < config.RABBITMQ_QUEUE_SIZE:
-            logger.info(f"Queue below threshold ({config.RABBITMQ_QUEUE_SIZE}), fetching more jobs.")
-            job_data = fetch_job_from_supabase(conn)
-            if not job_data:
-                break
+        deficit = config.RABBITMQ_QUEUE_SIZE - queue_length
+        logger.info(f"Queue below threshold ({config.RABBITMQ_QUEUE_SIZE}), claiming up to {deficit} job(s).")
+        jobs = fetch_jobs_from_supabase(deficit)
+        if not jobs:
+            return False
 
-            if validate_supabase_job_data(job_data):
-                add_job_to_queue(channel, job_data)
+        unpublished_jobs.set(len(jobs) + len(pending_publishes))
+        valid_jobs = [job for job in jobs if validate_supabase_job_data(job)]
+        if len(valid_jobs) < len(jobs):
+            fail_expired_jobs([job for job in jobs if job not in valid_jobs])
 
-            queue_length = get_queue_length(channel)
-            time.sleep(2)
+        unpublished_jobs.set(len(valid_jobs) + len(pending_publishes))
+        failed_jobs = add_jobs_to_queue(publisher, valid_jobs, pending_publishes)
+        unpublished_jobs.set(len(failed_jobs) + len(pending_publishes))
+        if failed_jobs:
+            revert_supabase_jobs_to_queued([job.id for job in failed_jobs])
+            unpublished_jobs.set(len(pending_publishes))
+            # Reverting notifies the filler again, so give the broker some time before the jobs are claimed again
+            time.sleep(RECONNECT_DELAY)
+            return False
+
+        return len(jobs) == deficit
 
     except Exception as e:
-        logger.error(f"Error fetching jobs: {e}")
\ No newline at end of file
+        logger.error(f"Error fetching jobs: {e}")
+        return False
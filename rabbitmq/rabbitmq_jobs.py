@@ -0,0 +1,79 @@
+import json
+from datetime import datetime
+from typing import Optional
+from data_types.types import SupabaseJobQueueType, JobStatus, JobType, TextToImageRequestType, StableDiffusionExecutionType
+from generate.text_to_image import validate_text_to_image
+from generate.text_to_portrait import validate_text_to_portrait
+from helpers.execution_metadata import create_execution_metadata
+from helpers.image_encoding import encode_images
+from helpers.logger import logger
+from helpers.metrics import counter
+from helpers.progress import get_step_percentiles
+from helpers.timing import JobTimings
+from supabase_helpers.supabase_images import create_supabase_image_entities
+from rabbitmq.rabbitmq_results import update_job_status
+
+jobs_finished = counter("jobs_finished_total", "Jobs finished by this process", ("outcome",))
+
+# Best effort extraction of the job id from a raw message body
+def get_task_id(body) -> Optional[str]:
+    try:
+        return json.loads(body).get('id')
+    except Exception:
+        return None
+
+# Validate and moderate a job according to its job type
+def validate_job(task_data: SupabaseJobQueueType) -> TextToImageRequestType:
+    if task_data.job_type == JobType.TEXT_TO_IMAGE:
+        return validate_text_to_image(task_data)
+    elif task_data.job_type == JobType.TEXT_TO_PORTRAIT:
+        return validate_text_to_portrait(task_data)
+    else:
+        raise Exception(f"invalid job type: {task_data.job_type}")
+
+# Step duration percentiles over the pipeline calls that generated the images of a job
+def get_job_step_metadata(executions: list[StableDiffusionExecutionType]) -> Optional[dict]:
+    pipeline_calls = {id(execution.step_durations): execution.step_durations for execution in executions if execution.step_durations}
+    step_percentiles = get_step_percentiles([duration for durations in pipeline_calls.values() for duration in durations])
+    return {"step_ms": step_percentiles} if step_percentiles else None
+
+# Encode and store the generated images of a job, mark it as succeeded and acknowledge its message
+def complete_job(ch, delivery_tag, task_data: SupabaseJobQueueType, executions: list[StableDiffusionExecutionType], timings: Optional[JobTimings] = None):
+    if len(executions) != task_data.request_data.num_options:
+        raise Exception(f"Number of generated images ({len(executions)}) did not match the request ({task_data.request_data.num_options})")
+
+    unencoded = [execution for execution in executions if execution.image is None]
+    encoded = encode_images(
+        [execution.raw_image for execution in unencoded],
+        [execution.output_format for execution in unencoded],
+        [execution.output_quality for execution in unencoded]
+    )
+    for execution, image in zip(unencoded, encoded):
+        execution.image = image
+        execution.raw_image = None
+
+    try:
+        create_supabase_image_entities(executions, task_data)
+    except Exception as e:
+        raise Exception(f"Image upload failed: {e}") from e
+
+    try:
+        total_runtime = sum(execution.runtime for execution in executions)
+        execution_metadata = create_execution_metadata(total_runtime, get_job_step_metadata(executions), timings)
+        update_job_status(task_data.id, JobStatus.SUCCEEDED, execution_metadata)
+    except Exception:
+        raise Exception(f"Database update failed")
+
+    ch.basic_ack(delivery_tag=delivery_tag)
+    jobs_finished.labels("succeeded").inc()
+
+# Reject the message of a failed job and mark the job as failed
+def fail_job(ch, delivery_tag, task_id, start_time: datetime, error: Exception, timings: Optional[JobTimings] = None):
+    logger.exception(f"Failed to process task {task_id}, error: {error}")
+    ch.basic_nack(delivery_tag=delivery_tag, requeue=False)
+    jobs_finished.labels("failed").inc()
+
+    if task_id is not None:
+        # Wall time since delivery, the timings break it down into the stages the job got through before failing
+        estimated_runtime = int((datetime.now() - start_time).total_seconds() * 1000)
+        update_job_status(task_id, JobStatus.FAILED, create_execution_metadata(estimated_runtime, {"error": str(error)}, timings))
@@ -0,0 +1,49 @@
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from queue import Queue
+from data_types.types import SupabaseJobQueueType, StableDiffusionExecutionType
+from helpers.load_config import load_config
+from helpers.logger import logger
+from helpers.timing import JobTimings, job_timing
+from rabbitmq.rabbitmq_jobs import complete_job, fail_job
+
+config = load_config()
+
+@dataclass
+class PostProcessingTask:
+    delivery_tag: str
+    task_data: SupabaseJobQueueType
+    executions: list[StableDiffusionExecutionType]
+    start_time: datetime
+    timings: JobTimings
+
+# Encodes, uploads and stores finished jobs on background workers while the GPU generates the next job
+class PostProcessor:
+    def __init__(self, channel, workers: int = config.POSTPROCESS_WORKERS, queue_size: int = config.POSTPROCESS_QUEUE_SIZE):
+        self.channel = channel  # must be safe to use from worker threads (see AsyncRabbitMQ)
+        self.queue: Queue[PostProcessingTask] = Queue(maxsize=queue_size)
+        for i in range(workers):
+            threading.Thread(target=self.run, name=f"postprocessor-{i}", daemon=True).start()
+
+    # Blocks while the queue is full, so generation never runs ahead of slow storage
+    def submit(self, delivery_tag, task_data: SupabaseJobQueueType, executions: list[StableDiffusionExecutionType], start_time: datetime, timings: JobTimings):
+        if self.queue.full():
+            logger.warning(f"Post-processing queue is full, waiting before handing over job {task_data.id}")
+        self.queue.put(PostProcessingTask(delivery_tag=delivery_tag, task_data=task_data, executions=executions, start_time=start_time, timings=timings))
+
+    # Wait until every submitted job has been stored
+    def join(self):
+        self.queue.join()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                with job_timing(task.timings):
+                    complete_job(self.channel, task.delivery_tag, task.task_data, task.executions, task.timings)
+                logger.info(f"Completed Job {task.task_data.id}")
+            except Exception as e:
+                fail_job(self.channel, task.delivery_tag, task.task_data.id, task.start_time, e, task.timings)
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,33 @@
+import json
+import threading
+import pika
+from helpers.load_config import load_config
+from helpers.progress import ProgressEvent
+from rabbitmq.rabbitmq_async_connection import AsyncRabbitMQ
+
+config = load_config()
+_progressPublisher: AsyncRabbitMQ = None
+_progressPublisherLock = threading.Lock()
+
+def get_progress_publisher() -> AsyncRabbitMQ:
+    global _progressPublisher
+    with _progressPublisherLock:
+        if _progressPublisher is None:
+            publisher = AsyncRabbitMQ()
+            publisher.declare_exchange(config.PROGRESS_EXCHANGE, "topic")
+            publisher.start()
+            _progressPublisher = publisher
+    return _progressPublisher
+
+# Publish a progress event to the progress topic, routed by job id. Progress is transient, so nothing is persisted
+# or confirmed and events published while the connection is down are dropped.
+def publish_progress(event: ProgressEvent):
+    publisher = get_progress_publisher()
+    body = json.dumps(event.json())
+    for job_id in event.job_ids:
+        publisher.publish(
+            routing_key=str(job_id),
+            body=body,
+            properties=pika.BasicProperties(delivery_mode=1, content_type="application/json"),
+            exchange=config.PROGRESS_EXCHANGE
+        )
@@ -1,29 +1,77 @@
+from concurrent.futures import Future, wait
+
 import pika
 
 from data_types.types import SupabaseJobQueueType
 from helpers.load_config import load_config
 from helpers.logger import logger
+from helpers.metrics import counter, gauge, histogram
+from rabbitmq.rabbitmq_async_connection import AsyncRabbitMQ
 
 config = load_config()
 
+publishes_confirmed = counter("rabbitmq_publish_confirmed_total", "Jobs confirmed by RabbitMQ")
+publishes_failed = counter("rabbitmq_publish_failed_total", "Jobs nacked by RabbitMQ or lost with the publisher channel")
+publish_confirm_latency = histogram("rabbitmq_publish_confirm_seconds", "Time RabbitMQ took to confirm a published job")
+queue_depth = gauge("rabbitmq_queue_depth", "Messages in the job queue when it was last checked")
+
 # Get the length of the RabbitMQ queue.
 def get_queue_length(channel):
     try:
         queue_state = channel.queue_declare(queue=config.RABBITMQ_QUEUE, passive=True)
+        queue_depth.set(queue_state.method.message_count)
         return queue_state.method.message_count
     except Exception as e:
         logger.error(f"Failed to get local RabbitMQ queue length: {e}")
         return None
 
-# Add a job to the RabbitMQ queue.
-def add_job_to_queue(channel, job_data: SupabaseJobQueueType):
-    try:
-        channel.basic_publish(
-            exchange='',
+def record_publish_result(job_data: SupabaseJobQueueType, future: Future) -> bool:
+    if future.exception() is not None:
+        logger.error(f"{job_data.id} - Failed to add job to RabbitMQ: {future.exception()}")
+        publishes_failed.inc()
+        return False
+    publishes_confirmed.inc()
+    publish_confirm_latency.observe(future.result())
+    return True
+
+# Publish a batch of jobs and wait for all of their confirms at once.
+# Returns the jobs whose publish was nacked or lost with the channel. A job that was not confirmed within
+# PUBLISH_CONFIRM_TIMEOUT_MS is not returned: the broker may still accept and deliver it, so putting it back into the
+# queue could run it twice. Its publish is added to pending instead, until the broker answers or the channel is lost,
+# which always happens eventually (see collect_late_publish_results).
+def add_jobs_to_queue(publisher: AsyncRabbitMQ, jobs: list[SupabaseJobQueueType], pending: dict[Future, SupabaseJobQueueType]) -> list[SupabaseJobQueueType]:
+    futures = {}
+    for job_data in jobs:
+        future = publisher.publish(
             routing_key=config.RABBITMQ_QUEUE,
             body=job_data.json(),
             properties=pika.BasicProperties(delivery_mode=2, message_id=job_data.id),
         )
-        logger.info(f"{job_data.id} - Job added to RabbitMQ Queue")
-    except Exception as e:
-        logger.error(f"{job_data.id} - Failed to add job to RabbitMQ: {e}")
\ No newline at end of file
+        futures[future] = job_data
+
+    done, _ = wait(futures, timeout=config.PUBLISH_CONFIRM_TIMEOUT_MS / 1000)
+
+    failed_jobs = []
+    unconfirmed = 0
+    for future, job_data in futures.items():
+        if future not in done:
+            logger.warning(f"{job_data.id} - Job was not confirmed by RabbitMQ within {config.PUBLISH_CONFIRM_TIMEOUT_MS}ms, waiting for the broker")
+            pending[future] = job_data
+            unconfirmed += 1
+        elif not record_publish_result(job_data, future):
+            failed_jobs.append(job_data)
+
+    if jobs:
+        logger.info(f"Published {len(jobs) - len(failed_jobs) - unconfirmed} of {len(jobs)} job(s) to RabbitMQ Queue, {unconfirmed} still unconfirmed "
+                    f"(confirmed: {publishes_confirmed.labels().value}, failed: {publishes_failed.labels().value})")
+    return failed_jobs
+
+# Take the publishes that were answered since they timed out out of pending. Returns the jobs whose publish failed.
+# Polled from the publishing thread, so nothing blocking runs on the I/O thread of the publisher.
+def collect_late_publish_results(pending: dict[Future, SupabaseJobQueueType]) -> list[SupabaseJobQueueType]:
+    failed_jobs = []
+    for future in [future for future in pending if future.done()]:
+        job_data = pending.pop(future)
+        if not record_publish_result(job_data, future):
+            failed_jobs.append(job_data)
+    return failed_jobs
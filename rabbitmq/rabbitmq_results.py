@@ -0,0 +1,78 @@
+import json
+import threading
+import uuid
+from collections import deque
+from functools import partial
+
+import pika
+
+from data_types.types import JobStatus
+from helpers.load_config import load_config
+from helpers.logger import logger
+from rabbitmq.rabbitmq_async_connection import AsyncRabbitMQ
+from rabbitmq.rabbitmq_connection import RECONNECT_DELAY
+from supabase_helpers.supabase_job_queue import update_supabase_job_queue
+
+config = load_config()
+_resultsPublisher: AsyncRabbitMQ = None
+_resultsPublisherLock = threading.Lock()
+
+# Events not confirmed by the broker yet per job, oldest first. Only the oldest event of a job is published at a time,
+# so a failed publish is retried before any later status of the same job can reach the results queue.
+_pendingEvents: dict[str, deque] = {}
+_pendingEventsLock = threading.Lock()
+
+def get_results_publisher() -> AsyncRabbitMQ:
+    global _resultsPublisher
+    with _resultsPublisherLock:
+        if _resultsPublisher is None:
+            publisher = AsyncRabbitMQ(confirm_delivery=True)
+            publisher.declare(config.RABBITMQ_RESULTS_QUEUE)
+            publisher.start()
+            _resultsPublisher = publisher
+    return _resultsPublisher
+
+# Record a job status change. With JOB_STATUS_WRITER the change is published to the results queue and written in bulk
+# by MODE=writer, otherwise it is written directly. Events of a job reach the results queue in the order they happened.
+def update_job_status(job_id, job_status: JobStatus, execution_metadata_update=None):
+    if not config.JOB_STATUS_WRITER:
+        update_supabase_job_queue(job_id, job_status, execution_metadata_update)
+        return
+
+    # The message id stays the same across retries, so the writer recognises a publish that did reach the broker
+    event = (str(uuid.uuid4()), {"id": job_id, "job_status": job_status.value, "execution_metadata": execution_metadata_update})
+    with _pendingEventsLock:
+        pending = _pendingEvents.setdefault(job_id, deque())
+        pending.append(event)
+        if len(pending) > 1:
+            return
+    publish_job_status(event)
+
+def publish_job_status(event: tuple[str, dict]):
+    message_id, body = event
+    future = get_results_publisher().publish(
+        routing_key=config.RABBITMQ_RESULTS_QUEUE,
+        body=json.dumps(body),
+        properties=pika.BasicProperties(delivery_mode=2, message_id=message_id, content_type="application/json"),
+    )
+    future.add_done_callback(partial(on_job_status_published, event))
+
+# Publish the next event of the job once the broker confirmed this one, retry it otherwise. A direct write is no fallback,
+# it could apply a status before earlier ones of the same job still waiting in the results queue.
+def on_job_status_published(event: tuple[str, dict], future):
+    job_id = event[1]["id"]
+    if future.exception() is not None:
+        logger.error(f"{job_id} - Failed to publish status {event[1]['job_status']}, retrying in {RECONNECT_DELAY} seconds: {future.exception()}")
+        retry = threading.Timer(RECONNECT_DELAY, publish_job_status, args=(event,))
+        retry.daemon = True
+        retry.start()
+        return
+
+    with _pendingEventsLock:
+        pending = _pendingEvents[job_id]
+        pending.popleft()
+        if not pending:
+            del _pendingEvents[job_id]
+            return
+        next_event = pending[0]
+    publish_job_status(next_event)
@@ -0,0 +1,210 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import urllib.request
+from dataclasses import dataclass, field
+from typing import Optional
+from helpers.cuda import get_consumer_devices
+from helpers.load_config import load_config
+from helpers.logger import logger
+from helpers.metrics import gauge, registry, start_metrics_server
+
+config = load_config()
+
+MAX_RESTART_DELAY = 300  # seconds
+
+@dataclass
+class WorkerHeartbeat:
+    device: str
+    pid: int
+    ready: bool
+    jobs_succeeded: int = 0
+    jobs_failed: int = 0
+
+@dataclass
+class Worker:
+    device: str
+    process: Optional[multiprocessing.Process] = None
+    heartbeat: Optional[WorkerHeartbeat] = None
+    last_heartbeat: float = 0
+    restarts: int = 0
+    restart_delay: float = config.WORKER_RESTART_DELAY
+    restart_at: Optional[float] = None
+    jobs_succeeded: int = 0  # jobs of previous processes on this device
+    jobs_failed: int = 0
+    exit_codes: list[int] = field(default_factory=list)
+
+# Entry point of a worker process. WORKER_DEVICE is already set in its environment, so the configuration,
+# the pipeline and the AMQP connection of the worker are all bound to its device.
+def run_consumer_worker(heartbeats):
+    from open_ai.openai_wrapper import get_openai
+    from rabbitmq.rabbitmq_consumer import subscribe_to_rabbitmq
+    from stable_diffusion.stable_diffusion_manager import get_stable_diffusion
+    from supabase_helpers.supabase_team import get_team_settings
+
+    state = {"ready": False}
+    threading.Thread(target=send_heartbeats, args=(heartbeats, state), name="heartbeat", daemon=True).start()
+    start_metrics_server(config.WORKER_METRICS_PORT)
+
+    get_stable_diffusion()
+    get_openai()
+    get_team_settings()
+    state["ready"] = True
+
+    subscribe_to_rabbitmq()
+
+def send_heartbeats(heartbeats, state: dict):
+    from rabbitmq.rabbitmq_jobs import jobs_finished
+
+    while True:
+        heartbeats.put(WorkerHeartbeat(
+            device=config.WORKER_DEVICE,
+            pid=os.getpid(),
+            ready=state["ready"],
+            jobs_succeeded=jobs_finished.labels("succeeded").value,
+            jobs_failed=jobs_finished.labels("failed").value
+        ))
+        time.sleep(config.WORKER_HEARTBEAT_INTERVAL)
+
+# Runs one consumer worker process per device, restarts crashed workers and logs their aggregated health
+class ConsumerSupervisor:
+    def __init__(self, devices: list[str]):
+        # Spawned workers start from a clean interpreter, CUDA cannot be used in forked processes
+        self.context = multiprocessing.get_context("spawn")
+        self.heartbeats = self.context.Queue()
+        self.workers = [Worker(device=device) for device in devices]
+        self.last_report = 0
+
+        gauge("consumer_workers", "Consumer worker processes", callback=lambda: len(self.workers))
+        gauge("consumer_workers_ready", "Consumer worker processes that are ready and sent a recent heartbeat", callback=self.count_ready_workers)
+        gauge("consumer_worker_restarts", "Restarts of consumer worker processes", callback=lambda: sum(worker.restarts for worker in self.workers))
+        registry.collectors.append(self.collect_worker_metrics)
+
+    def get_worker_metrics_port(self, index: int) -> int:
+        return config.METRICS_PORT + 1 + index if config.METRICS_PORT else 0
+
+    def count_ready_workers(self) -> int:
+        now = time.monotonic()
+        return sum(
+            1 for worker in self.workers
+            if worker.heartbeat is not None and worker.heartbeat.ready and now - worker.last_heartbeat < config.WORKER_HEARTBEAT_INTERVAL * 3
+        )
+
+    # Scrape the metrics of every worker, labelled with the worker and its device
+    def collect_worker_metrics(self) -> list[tuple[str, str]]:
+        expositions = []
+        for index, worker in enumerate(self.workers):
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{self.get_worker_metrics_port(index)}/metrics", timeout=2) as response:
+                    expositions.append((f'worker="{index}",device="{worker.device}"', response.read().decode("utf-8")))
+            except Exception as e:
+                logger.debug(f"Failed to scrape metrics of consumer worker {index}: {e}")
+        return expositions
+
+    def start_worker(self, index: int, worker: Worker):
+        # The worker inherits the environment at start, which is how it learns its device and metrics port
+        os.environ["WORKER_DEVICE"] = worker.device
+        os.environ["WORKER_METRICS_PORT"] = str(self.get_worker_metrics_port(index))
+        try:
+            worker.process = self.context.Process(target=run_consumer_worker, args=(self.heartbeats,), name=f"consumer-{index}")
+            worker.process.start()
+        finally:
+            os.environ.pop("WORKER_DEVICE", None)
+            os.environ.pop("WORKER_METRICS_PORT", None)
+
+        worker.heartbeat = None
+        worker.last_heartbeat = time.monotonic()
+        worker.restart_at = None
+        logger.info(f"Started consumer worker {index} on {worker.device} (pid {worker.process.pid})")
+
+    def run(self):
+        logger.info(f"Starting {len(self.workers)} consumer worker(s) on: {[worker.device for worker in self.workers]}")
+        start_metrics_server(config.METRICS_PORT)
+        for index, worker in enumerate(self.workers):
+            self.start_worker(index, worker)
+
+        try:
+            while True:
+                self.receive_heartbeats(timeout=1)
+                self.check_workers()
+                if time.monotonic() - self.last_report >= config.WORKER_HEARTBEAT_INTERVAL * 3:
+                    self.report()
+        finally:
+            self.stop()
+
+    def receive_heartbeats(self, timeout: float):
+        try:
+            heartbeat = self.heartbeats.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+        while heartbeat is not None:
+            for worker in self.workers:
+                if worker.process is not None and worker.process.pid == heartbeat.pid:
+                    if heartbeat.ready and (worker.heartbeat is None or not worker.heartbeat.ready):
+                        logger.info(f"Consumer worker on {worker.device} is ready")
+                        worker.restart_delay = config.WORKER_RESTART_DELAY
+                    worker.heartbeat = heartbeat
+                    worker.last_heartbeat = time.monotonic()
+            try:
+                heartbeat = self.heartbeats.get_nowait()
+            except queue.Empty:
+                heartbeat = None
+
+    def check_workers(self):
+        now = time.monotonic()
+        for index, worker in enumerate(self.workers):
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.restarts += 1
+                    self.start_worker(index, worker)
+                continue
+
+            if worker.process.is_alive():
+                continue
+
+            # Keep the job counts of the crashed process
+            if worker.heartbeat is not None:
+                worker.jobs_succeeded += worker.heartbeat.jobs_succeeded
+                worker.jobs_failed += worker.heartbeat.jobs_failed
+            crashed_before_ready = worker.heartbeat is None or not worker.heartbeat.ready
+            worker.exit_codes.append(worker.process.exitcode)
+            worker.heartbeat = None
+
+            logger.error(f"Consumer worker {index} on {worker.device} exited with code {worker.process.exitcode}, restarting in {worker.restart_delay} seconds")
+            worker.restart_at = now + worker.restart_delay
+            if crashed_before_ready:
+                worker.restart_delay = min(worker.restart_delay * 2, MAX_RESTART_DELAY)
+
+    # Log the health of all workers and the jobs they finished
+    def report(self):
+        self.last_report = time.monotonic()
+        now = time.monotonic()
+        ready = self.count_ready_workers()
+        succeeded = 0
+        failed = 0
+        for worker in self.workers:
+            succeeded += worker.jobs_succeeded
+            failed += worker.jobs_failed
+            if worker.heartbeat is not None:
+                succeeded += worker.heartbeat.jobs_succeeded
+                failed += worker.heartbeat.jobs_failed
+
+        restarts = sum(worker.restarts for worker in self.workers)
+        logger.info(f"Consumer workers: {ready}/{len(self.workers)} ready, {restarts} restart(s), jobs succeeded: {succeeded}, failed: {failed}")
+        for index, worker in enumerate(self.workers):
+            if worker.heartbeat is not None and now - worker.last_heartbeat >= config.WORKER_HEARTBEAT_INTERVAL * 3:
+                logger.warning(f"Consumer worker {index} on {worker.device} has not sent a heartbeat for {now - worker.last_heartbeat:.0f} seconds")
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout=10)
+
+def supervise_consumers():
+    ConsumerSupervisor(get_consumer_devices()).run()
@@ -0,0 +1,72 @@
+import json
+import time
+from queue import Queue, Empty
+from data_types.types import JobStatus
+from helpers.load_config import load_config
+from helpers.logger import logger
+from rabbitmq.rabbitmq_async_connection import AsyncRabbitMQ
+from rabbitmq.rabbitmq_connection import RECONNECT_DELAY
+from supabase_helpers.supabase_job_queue import update_supabase_job_queue_bulk
+
+config = load_config()
+
+# Main function of MODE=writer: drain job status events published by the consumers and apply them in bulk
+def rabbitmq_to_supabase():
+    events = Queue()
+    rabbitmq = AsyncRabbitMQ()
+    # A single consumer keeps the events of every job in publish order
+    rabbitmq.consume(
+        queue=config.RABBITMQ_RESULTS_QUEUE,
+        prefetch_count=config.WRITER_BATCH_SIZE,
+        on_message=lambda delivery_tag, body: events.put((delivery_tag, body))
+    )
+    rabbitmq.start()
+    logger.info(f"Writing job status updates from queue: {config.RABBITMQ_RESULTS_QUEUE}")
+
+    while True:
+        batch = take_events(events)
+        if batch:
+            write_events(rabbitmq, batch)
+
+# Wait for the first event, then collect events until the batch is full or WRITER_BATCH_MAX_WAIT_MS elapsed
+def take_events(events: Queue) -> list:
+    try:
+        batch = [events.get(timeout=1)]
+    except Empty:
+        return []
+
+    deadline = time.monotonic() + config.WRITER_BATCH_MAX_WAIT_MS / 1000
+    while len(batch) < config.WRITER_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(events.get(timeout=remaining))
+        except Empty:
+            break
+    return batch
+
+# Apply a batch of events in delivery order. Events are acknowledged only once they are written.
+# A failed write is retried in place: requeued events would come back behind later, already prefetched events of the same job.
+def write_events(rabbitmq: AsyncRabbitMQ, batch: list):
+    updates = []
+    delivery_tags = []
+    for delivery_tag, body in batch:
+        try:
+            event = json.loads(body)
+            updates.append((event['id'], JobStatus(event['job_status']), event.get('execution_metadata')))
+            delivery_tags.append(delivery_tag)
+        except Exception as e:
+            logger.error(f"Discarding invalid job status event {body}: {e}")
+            rabbitmq.basic_nack(delivery_tag, requeue=False)
+
+    while True:
+        try:
+            update_supabase_job_queue_bulk(updates)
+            break
+        except Exception as e:
+            logger.error(f"Failed to write {len(updates)} job status update(s), retrying in {RECONNECT_DELAY} seconds: {e}")
+            time.sleep(RECONNECT_DELAY)
+
+    for delivery_tag in delivery_tags:
+        rabbitmq.basic_ack(delivery_tag)
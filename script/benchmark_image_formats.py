@@ -0,0 +1,54 @@
+# Compare encode time and size of the supported output formats on a generated image.
+# Usage: python script/benchmark_image_formats.py [image] [--runs 5] [--qualities 75,85,90]
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PIL import Image
+from helpers.image_formats import IMAGE_FORMATS, encode_image, get_image_format, is_format_supported
+
+def benchmark(image: Image.Image, format_name: str, quality, compress_level: int, runs: int):
+    image_format = get_image_format(format_name)
+    durations = []
+    size = 0
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        size = len(encode_image(image, image_format, quality, compress_level))
+        durations.append((time.perf_counter() - start_time) * 1000)
+    return statistics.median(durations), size
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark output image formats")
+    parser.add_argument("image", nargs="?", default="tests/assets/out.png", help="image to encode")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--qualities", default="75,85,90", help="comma separated qualities for lossy formats")
+    parser.add_argument("--compress-levels", default="1,6,9", help="comma separated PNG compression levels")
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert("RGB")
+    image.load()
+    raw_size = image.width * image.height * 3
+    print(f"{args.image}: {image.width}x{image.height}, median of {args.runs} run(s)")
+    print(f"{'format':<8} {'setting':<12} {'encode ms':>10} {'bytes':>12} {'ratio':>7}")
+
+    for format_name, image_format in IMAGE_FORMATS.items():
+        if not is_format_supported(format_name):
+            print(f"{format_name:<8} not supported by this Pillow installation")
+            continue
+
+        if image_format.lossy:
+            settings = [(f"quality={quality}", int(quality), 6) for quality in args.qualities.split(",")]
+        else:
+            settings = [(f"level={level}", None, int(level)) for level in args.compress_levels.split(",")]
+
+        for label, quality, compress_level in settings:
+            duration, size = benchmark(image, format_name, quality, compress_level, args.runs)
+            print(f"{format_name:<8} {label:<12} {duration:>10.1f} {size:>12,} {raw_size / size:>6.1f}x")
+
+if __name__ == "__main__":
+    main()
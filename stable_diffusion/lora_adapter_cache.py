@@ -0,0 +1,111 @@
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Sequence
+from data_types.types import ImagePluginType
+from helpers.logger import logger
+
+@dataclass
+class LoraAdapterCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    load_ms_total: float = 0
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def load_ms_avg(self) -> float:
+        return self.load_ms_total / self.misses if self.misses else 0
+
+# Keeps plugins (LoRAs) loaded into the pipeline as named adapters, so a request only switches the active adapters
+# instead of loading and unloading its LoRA weights. Adapters are evicted least recently used first once more than
+# max_adapters are loaded or their safetensors files add up to more than max_bytes.
+# Not thread-safe, only to be used from the thread running the pipeline.
+class LoraAdapterCache:
+    def __init__(self, pipeline, max_adapters: int, max_bytes: int):
+        self.pipeline = pipeline
+        self.max_adapters = max_adapters
+        self.max_bytes = max_bytes
+        self.adapters: OrderedDict[str, int] = OrderedDict()  # adapter name -> size in bytes, least recently used first
+        self.active: list[str] = []
+        self.stats = LoraAdapterCacheStats()
+
+    @staticmethod
+    def get_adapter_name(plugin_id: str) -> str:
+        # PEFT uses adapter names as module keys, which must not contain dots
+        return "plugin_" + re.sub(r"\W", "_", str(plugin_id))
+
+    def loaded_bytes(self) -> int:
+        return sum(self.adapters.values())
+
+    # Activate exactly the given plugins with their weights, loading the ones that are not resident yet
+    def activate(self, plugins: Sequence[ImagePluginType], get_plugin_path: Callable[[str], str]):
+        if not plugins:
+            self.deactivate()
+            return
+
+        names = [self.get_adapter_name(plugin.id) for plugin in plugins]
+        for plugin, name in zip(plugins, names):
+            self.load(name, get_plugin_path(plugin.id), keep=names)
+
+        self.pipeline.enable_lora()
+        self.pipeline.set_adapters(names, adapter_weights=[plugin.weight for plugin in plugins])
+        self.active = names
+
+    def deactivate(self):
+        if self.active:
+            self.pipeline.disable_lora()
+            self.active = []
+
+    def load(self, name: str, lora_path: str, keep: list[str]):
+        if name in self.adapters:
+            self.adapters.move_to_end(name)
+            self.stats.hits += 1
+            return
+
+        self.stats.misses += 1
+        size = os.path.getsize(lora_path)
+        self.evict(keep, incoming_bytes=size)
+
+        start_time = time.monotonic()
+        try:
+            self.pipeline.load_lora_weights(lora_path, adapter_name=name)
+        except Exception:
+            # Drop whatever part of the adapter was already injected
+            try:
+                self.pipeline.delete_adapters(name)
+            except Exception:
+                pass
+            raise
+        load_ms = (time.monotonic() - start_time) * 1000
+
+        self.stats.load_ms_total += load_ms
+        self.adapters[name] = size
+        logger.info(f"Loaded Plugin (LoRA) adapter {name} in {load_ms:.0f}ms ({len(self.adapters)} resident, hit rate: {self.stats.hit_rate():.0%})")
+
+    # Make room for an adapter of incoming_bytes, never evicting the adapters in keep
+    def evict(self, keep: list[str], incoming_bytes: int):
+        while self.adapters and (len(self.adapters) + 1 > self.max_adapters or self.loaded_bytes() + incoming_bytes > self.max_bytes):
+            name = next((name for name in self.adapters if name not in keep), None)
+            if name is None:
+                break
+            self.remove(name)
+            self.stats.evictions += 1
+            logger.info(f"Evicted Plugin (LoRA) adapter {name}")
+
+    # Unload the adapter of a removed plugin, if it is resident
+    def remove_plugin(self, plugin_id: str):
+        name = self.get_adapter_name(plugin_id)
+        if name in self.adapters:
+            self.remove(name)
+            logger.info(f"Unloaded Plugin (LoRA) adapter {name} of a removed plugin")
+
+    def remove(self, name: str):
+        self.pipeline.delete_adapters(name)
+        self.adapters.pop(name, None)
+        if name in self.active:
+            self.active.remove(name)
@@ -0,0 +1,121 @@
+from collections import Counter, OrderedDict, deque
+from typing import Dict, Hashable, List, Optional
+import torch
+
+# Fusing the active LoRA adapters of a popular plugin combination into the base weights saves the extra LoRA matmuls in
+# every layer of every denoising step. Only depends on torch and on the PEFT LoRA layer interface (base_layer,
+# active_adapters, get_delta_weight), so it can be tested without a pipeline.
+
+def get_lora_layers(models: Dict[str, torch.nn.Module]) -> Dict[str, torch.nn.Module]:
+    layers = {}
+    for prefix, model in models.items():
+        for name, module in model.named_modules():
+            if hasattr(module, "base_layer") and hasattr(module, "get_delta_weight") and hasattr(module, "lora_A"):
+                layers[f"{prefix}.{name}"] = module
+    return layers
+
+# Sum the weight deltas of the active adapters of every LoRA layer, with the adapter weights they are currently scaled by
+def compute_fused_deltas(models: Dict[str, torch.nn.Module], device="cpu") -> Dict[str, torch.Tensor]:
+    deltas = {}
+    with torch.no_grad():
+        for name, layer in get_lora_layers(models).items():
+            adapters = [adapter for adapter in layer.active_adapters if adapter in layer.lora_A]
+            if not adapters:
+                continue
+            delta = sum(layer.get_delta_weight(adapter).float() for adapter in adapters)
+            deltas[name] = delta.to(device)
+    return deltas
+
+def get_deltas_bytes(deltas: Dict[str, torch.Tensor]) -> int:
+    return sum(delta.numel() * delta.element_size() for delta in deltas.values())
+
+# Writes fused deltas into the base weights. The original weights of every touched layer are snapshotted the first time
+# they are fused, so restore() brings back the exact base weights instead of subtracting the deltas again.
+class FusedWeights:
+    def __init__(self, models: Dict[str, torch.nn.Module], snapshot_device="cpu"):
+        self.models = models
+        self.snapshot_device = snapshot_device
+        self.snapshots: Dict[str, torch.Tensor] = {}
+        self.fused: List[str] = []
+        self.fused_key: Optional[Hashable] = None
+
+    def fuse(self, key: Hashable, deltas: Dict[str, torch.Tensor]):
+        if self.fused_key == key:
+            return
+        self.restore()
+
+        layers = get_lora_layers(self.models)
+        with torch.no_grad():
+            for name, delta in deltas.items():
+                weight = layers[name].base_layer.weight
+                if name not in self.snapshots:
+                    self.snapshots[name] = weight.detach().to(self.snapshot_device, copy=True)
+                base = self.snapshots[name].to(weight.device, dtype=torch.float32)
+                weight.copy_((base + delta.to(weight.device)).to(weight.dtype))
+                self.fused.append(name)
+        self.fused_key = key
+
+    def restore(self):
+        if not self.fused:
+            self.fused_key = None
+            return
+
+        layers = get_lora_layers(self.models)
+        with torch.no_grad():
+            for name in self.fused:
+                weight = layers[name].base_layer.weight
+                weight.copy_(self.snapshots[name].to(weight.device))
+        self.fused = []
+        self.fused_key = None
+
+# Counts how often each plugin combination was generated within the last window images
+class ComboTracker:
+    def __init__(self, window: int):
+        self.history = deque()
+        self.window = window
+        self.counts = Counter()
+
+    def record(self, key: Hashable, images: int = 1):
+        for _ in range(images):
+            self.history.append(key)
+            self.counts[key] += 1
+            if len(self.history) > self.window:
+                expired = self.history.popleft()
+                self.counts[expired] -= 1
+                if self.counts[expired] == 0:
+                    del self.counts[expired]
+
+    def is_popular(self, key: Hashable, top_k: int, min_count: int) -> bool:
+        return any(combo == key and count >= min_count for combo, count in self.counts.most_common(top_k))
+
+# Least recently used cache of fused deltas, bounded by their size in bytes
+class FusedDeltaCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Hashable, Dict[str, torch.Tensor]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Dict[str, torch.Tensor]]:
+        deltas = self.entries.get(key)
+        if deltas is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return deltas
+
+    # Drop the deltas of every plugin combination containing the plugin, keys are tuples of (plugin id, weight)
+    def invalidate_plugin(self, plugin_id: str):
+        for key in [key for key in self.entries if any(combo_plugin[0] == plugin_id for combo_plugin in key)]:
+            del self.entries[key]
+
+    def put(self, key: Hashable, deltas: Dict[str, torch.Tensor]) -> bool:
+        size = get_deltas_bytes(deltas)
+        if size > self.max_bytes:
+            return False
+        self.entries[key] = deltas
+        self.entries.move_to_end(key)
+        while sum(get_deltas_bytes(entry) for entry in self.entries.values()) > self.max_bytes:
+            self.entries.popitem(last=False)
+        return True
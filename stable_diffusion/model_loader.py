@@ -0,0 +1,119 @@
+import importlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import torch
+from helpers.load_config import load_config
+from helpers.logger import logger
+
+config = load_config()
+
+model_cache_dir = "./model_cache"
+
+# Files needed to assemble a diffusers pipeline from its component folders
+SNAPSHOT_PATTERNS = ["model_index.json", "*/*.json", "*/*.txt", "*/*.safetensors"]
+
+def get_manifest_path(model_id: str) -> str:
+    return os.path.join(model_cache_dir, f"{model_id.replace('/', '--')}.manifest.json")
+
+# The manifest records where a complete download of the model lives, so later boots never contact the Hub
+def read_manifest(model_id: str):
+    manifest_path = get_manifest_path(model_id)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    snapshot_path = manifest.get("snapshot_path")
+    if manifest.get("model_id") != model_id or not snapshot_path or not os.path.exists(os.path.join(snapshot_path, "model_index.json")):
+        logger.warning(f"Model manifest {manifest_path} is stale, downloading the model again")
+        return None
+    return manifest
+
+def write_manifest(model_id: str, snapshot_path: str, components: dict):
+    manifest = {
+        "model_id": model_id,
+        "snapshot_path": os.path.abspath(snapshot_path),
+        "components": components,
+        "downloaded_at": datetime.now().isoformat(),
+    }
+    manifest_path = get_manifest_path(model_id)
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+# Local folder of the model, downloaded from the Hub only if there is no manifest for it yet
+def get_model_snapshot(model_id: str) -> str:
+    manifest = read_manifest(model_id)
+    if manifest is not None:
+        logger.info(f"Using local model {model_id} from {manifest['snapshot_path']}")
+        return manifest["snapshot_path"]
+
+    from huggingface_hub import snapshot_download
+
+    logger.info(f"Downloading model {model_id} from the Hub...")
+    start_time = time.monotonic()
+    snapshot_path = snapshot_download(model_id, cache_dir=model_cache_dir, allow_patterns=SNAPSHOT_PATTERNS)
+    with open(os.path.join(snapshot_path, "model_index.json")) as f:
+        model_index = json.load(f)
+    write_manifest(model_id, snapshot_path, {name: value for name, value in model_index.items() if isinstance(value, list)})
+    logger.info(f"Downloaded model {model_id} in {time.monotonic() - start_time:.1f}s")
+    return snapshot_path
+
+def load_component(snapshot_path: str, name: str, library: str, class_name: str, device: str, dtype: torch.dtype):
+    start_time = time.monotonic()
+    component_class = getattr(importlib.import_module(library), class_name)
+    component_path = os.path.join(snapshot_path, name)
+
+    if issubclass(component_class, torch.nn.Module):
+        # Memory-map the safetensors and materialize the weights directly on the device in the target dtype
+        try:
+            component = component_class.from_pretrained(
+                component_path,
+                torch_dtype=dtype,
+                use_safetensors=True,
+                low_cpu_mem_usage=True,
+                device_map={"": device},
+                local_files_only=True
+            )
+        except (TypeError, ValueError, NotImplementedError) as e:
+            logger.warning(f"Could not load {name} straight to {device}, moving it after loading: {e}")
+            component = component_class.from_pretrained(component_path, torch_dtype=dtype, use_safetensors=True, local_files_only=True).to(device)
+    else:
+        component = component_class.from_pretrained(component_path, local_files_only=True)
+
+    return component, time.monotonic() - start_time
+
+# Assemble the pipeline from its components, loading them in parallel threads
+def load_pipeline(model_id: str, device: str, dtype: torch.dtype):
+    start_time = time.monotonic()
+    snapshot_path = get_model_snapshot(model_id)
+    with open(os.path.join(snapshot_path, "model_index.json")) as f:
+        model_index = json.load(f)
+
+    pipeline_kwargs = {}
+    futures = {}
+    with ThreadPoolExecutor(max_workers=config.MODEL_LOAD_WORKERS, thread_name_prefix="model-loader") as executor:
+        for name, value in model_index.items():
+            if name.startswith("_"):
+                continue
+            if not isinstance(value, list):
+                pipeline_kwargs[name] = value  # pipeline options such as force_zeros_for_empty_prompt
+            elif value[0] is None:
+                pipeline_kwargs[name] = None  # optional component not shipped with the model
+            else:
+                futures[name] = executor.submit(load_component, snapshot_path, name, value[0], value[1], device, dtype)
+
+        timings = {}
+        for name, future in futures.items():
+            pipeline_kwargs[name], timings[name] = future.result()
+
+    pipeline_class = getattr(importlib.import_module("diffusers"), model_index["_class_name"])
+    pipeline = pipeline_class(**pipeline_kwargs)
+
+    breakdown = ", ".join(f"{name}: {seconds:.1f}s" for name, seconds in sorted(timings.items(), key=lambda item: -item[1]))
+    logger.info(f"Loaded {model_id} on {device} in {time.monotonic() - start_time:.1f}s ({breakdown})")
+    return pipeline
@@ -0,0 +1,69 @@
+import os
+from typing import Iterable
+import torch
+from helpers.logger import logger
+
+def parse_resolutions(resolutions: str) -> list[tuple[int, int]]:
+    parsed = []
+    for resolution in resolutions.split(","):
+        if resolution.strip():
+            width, height = resolution.lower().strip().split("x")
+            parsed.append((int(width), int(height)))
+    return parsed
+
+def parse_batch_sizes(batch_sizes: str) -> list[int]:
+    return [int(batch_size) for batch_size in batch_sizes.split(",") if batch_size.strip()]
+
+# Keep compiled kernels and graphs on disk, so restarts reuse them instead of compiling again
+def configure_compile_cache(cache_dir: str):
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+    os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(cache_dir, "triton"))
+
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+
+# Replaces the forward of a module with a compiled version for a fixed set of (batch, height, width) input shapes.
+# Inputs of any other shape, and all inputs while disabled, run the original eager forward, so uncommon
+# resolutions and batch sizes never trigger a recompilation.
+class ShapeDispatchedForward:
+    def __init__(self, module: torch.nn.Module, shapes: Iterable[tuple[int, int, int]], **compile_kwargs):
+        self.module = module
+        self.eager = module.forward
+        self.compiled = torch.compile(module.forward, **compile_kwargs)
+        self.shapes = set(shapes)
+        self.enabled = True
+        module.forward = self
+
+    def __call__(self, *args, **kwargs):
+        sample = args[0] if args else kwargs.get("sample")
+        if self.enabled and (sample.shape[0], *sample.shape[-2:]) in self.shapes:
+            return self.compiled(*args, **kwargs)
+        return self.eager(*args, **kwargs)
+
+def has_lora_layers(module: torch.nn.Module) -> bool:
+    return any(hasattr(layer, "base_layer") and hasattr(layer, "lora_A") for layer in module.modules())
+
+# Loading a LoRA adapter replaces layers of the module with PEFT wrappers, which fails the guards of the graphs traced at
+# warm-up and would recompile them during live requests. A module with LoRA layers therefore runs eager from then on,
+# whether its adapters are active, disabled, fused into the base weights or deleted again.
+def update_compiled_forwards(compiled: list[ShapeDispatchedForward]):
+    for forward in compiled:
+        forward.enabled = not has_lora_layers(forward.module)
+
+# Compile the UNet and the VAE decoder of the pipeline for the given (width, height) resolutions and images per call.
+# With classifier-free guidance the UNet sees every image twice, unet_batch_factor is 2 then.
+def compile_pipeline(pipeline, resolutions: list[tuple[int, int]], batch_sizes: list[int], mode: str, cache_dir: str, unet_batch_factor: int = 2) -> list[ShapeDispatchedForward]:
+    configure_compile_cache(cache_dir)
+
+    # Every resolution and batch size is a separate graph
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, len(resolutions) * len(batch_sizes) * 2)
+
+    scale_factor = pipeline.vae_scale_factor
+    latent_shapes = [(height // scale_factor, width // scale_factor) for width, height in resolutions]
+    logger.info(f"Compiling the UNet and VAE decoder (mode: {mode}) for: {resolutions}, batch sizes: {batch_sizes}")
+    return [
+        ShapeDispatchedForward(pipeline.unet, [(batch_size * unet_batch_factor, *shape) for batch_size in batch_sizes for shape in latent_shapes], mode=mode),
+        ShapeDispatchedForward(pipeline.vae.decoder, [(batch_size, *shape) for batch_size in batch_sizes for shape in latent_shapes], mode=mode),
+    ]
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from typing import Callable, Dict
+from helpers.load_config import load_config
+from helpers.logger import logger
+from supabase_helpers.supabase_plugins import get_plugins_from_supabase
+from supabase_helpers.supabase_storage import download_file_from_supabase_bucket
+
+lora_cache_dir = "./lora_cache"
+
+config = load_config()
+_pluginRegistry = None
+_pluginRegistryLock = threading.Lock()
+
+def get_plugin_filename(plugin_id: str) -> str:
+    return f"{plugin_id}.safetensors"
+
+def get_local_plugin_path(plugin_id: str) -> str:
+    return os.path.join(lora_cache_dir, get_plugin_filename(plugin_id).replace("/", "_"))
+
+# Keeps the local LoRA cache in sync with the plugins table. A background thread picks up new and removed plugins
+# every PLUGIN_SYNC_INTERVAL seconds and prefetches new plugins, while plugins a job needs before they were prefetched
+# are downloaded on demand. Each plugin is downloaded at most once at a time.
+# The local file of a removed plugin is only deleted through delete_local_plugin, by the thread that may still be loading it.
+class PluginRegistry:
+    def __init__(self):
+        self.plugin_ids: set[str] = set()
+        self.paths: Dict[str, str] = {}  # Maps LoRA identifiers to local file paths
+        self.stale: set[str] = set()  # removed plugins whose local file must be downloaded again before it is used
+        self.locks: Dict[str, threading.Lock] = {}
+        self.removal_listeners: list[Callable[[str], None]] = []  # called with the id of every removed plugin
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="plugin-registry", daemon=True)
+
+    def start(self):
+        os.makedirs(lora_cache_dir, exist_ok=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"Failed to sync plugins, retrying in {config.PLUGIN_SYNC_INTERVAL} seconds: {e}")
+            time.sleep(config.PLUGIN_SYNC_INTERVAL)
+
+    def sync(self):
+        plugin_ids = set(get_plugins_from_supabase())
+        with self.lock:
+            added = plugin_ids - self.plugin_ids
+            removed = self.plugin_ids - plugin_ids
+            self.plugin_ids = plugin_ids
+
+        for plugin_id in removed:
+            self.remove_plugin(plugin_id)
+
+        if added or removed:
+            logger.info(f"Plugins synced: {len(added)} added, {len(removed)} removed")
+
+        if config.PLUGIN_PREFETCH:
+            for plugin_id in added:
+                try:
+                    self.get_plugin_path(plugin_id)
+                except FileNotFoundError:
+                    pass
+
+    def remove_plugin(self, plugin_id: str):
+        with self.get_plugin_lock(plugin_id):
+            self.paths.pop(plugin_id, None)
+            self.stale.add(plugin_id)
+        logger.info(f"Removed Plugin (LoRA): {plugin_id}")
+
+        for listener in self.removal_listeners:
+            listener(plugin_id)
+
+    # Delete the local file of a removed plugin, unless it was downloaded again in the meantime
+    def delete_local_plugin(self, plugin_id: str):
+        with self.get_plugin_lock(plugin_id):
+            if plugin_id not in self.stale:
+                return
+            self.stale.discard(plugin_id)
+            local_lora_path = get_local_plugin_path(plugin_id)
+            if os.path.exists(local_lora_path):
+                os.remove(local_lora_path)
+                logger.info(f"Deleted local file of removed Plugin (LoRA): {plugin_id}")
+
+    def get_plugin_lock(self, plugin_id: str) -> threading.Lock:
+        with self.lock:
+            return self.locks.setdefault(plugin_id, threading.Lock())
+
+    # Return the local path of a plugin, downloading it first if it is not cached yet
+    def get_plugin_path(self, plugin_id: str) -> str:
+        lora_path = self.paths.get(plugin_id)
+        if lora_path:
+            return lora_path
+
+        with self.get_plugin_lock(plugin_id):
+            lora_path = self.paths.get(plugin_id)
+            if lora_path:
+                return lora_path
+
+            # A plugin recreated under the id of a removed one must not be served from the old file
+            local_lora_path = get_local_plugin_path(plugin_id)
+            if not os.path.exists(local_lora_path) or plugin_id in self.stale:
+                self.download_plugin(plugin_id, local_lora_path)
+                self.stale.discard(plugin_id)
+            else:
+                logger.info(f"LoRA already downloaded: {plugin_id}")
+
+            self.paths[plugin_id] = local_lora_path
+            return local_lora_path
+
+    def download_plugin(self, plugin_id: str, local_lora_path: str):
+        filename = get_plugin_filename(plugin_id)
+        logger.info(f"Downloading Plugin (LoRA): {filename}")
+        try:
+            downloaded_file = download_file_from_supabase_bucket("plugin_weights", filename)
+        except Exception:
+            logger.exception(f"Failed to download LoRA: {filename}")
+            raise FileNotFoundError(f"Plugin (LoRA) not found: {plugin_id}")
+
+        # Write to a temporary file first, so an interrupted download never looks like a cached plugin
+        temporary_path = f"{local_lora_path}.download"
+        with open(temporary_path, "wb") as f:
+            f.write(downloaded_file)
+        os.replace(temporary_path, local_lora_path)
+
+def get_plugin_registry() -> PluginRegistry:
+    global _pluginRegistry
+
+    with _pluginRegistryLock:
+        if _pluginRegistry is None:
+            _pluginRegistry = PluginRegistry()
+            _pluginRegistry.start()
+    return _pluginRegistry
@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Optional
+import torch
+
+@dataclass
+class PromptEmbeddingCacheStats:
+    hits: int = 0
+    misses: int = 0
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+# Least recently used cache of text encoder outputs (prompt_embeds, pooled_prompt_embeds), bounded by their size in bytes.
+# Entries are keyed by (text, plugin combination), since plugins can change the text encoders.
+class PromptEmbeddingCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple[str, Hashable], tuple[torch.Tensor, torch.Tensor]] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = PromptEmbeddingCacheStats()
+
+    @staticmethod
+    def get_entry_bytes(entry: tuple[torch.Tensor, torch.Tensor]) -> int:
+        return sum(tensor.numel() * tensor.element_size() for tensor in entry)
+
+    def get(self, key: tuple[str, Hashable]) -> Optional[tuple[torch.Tensor, torch.Tensor]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry
+
+    def put(self, key: tuple[str, Hashable], entry: tuple[torch.Tensor, torch.Tensor]):
+        entry_bytes = self.get_entry_bytes(entry)
+        if entry_bytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.get_entry_bytes(self.entries.pop(key))
+            self.entries[key] = entry
+            self.size += entry_bytes
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.get_entry_bytes(evicted)
+
+    # Drop every entry encoded with the plugin, e.g. when the plugin was removed or its weights changed
+    def invalidate_plugin(self, plugin_id: str):
+        with self.lock:
+            for key in [key for key in self.entries if any(combo_plugin[0] == plugin_id for combo_plugin in key[1])]:
+                self.size -= self.get_entry_bytes(self.entries.pop(key))
@@ -1,156 +1,333 @@
-import logging
-import os
+import threading
+import time
+from dataclasses import replace
 from datetime import datetime
-from io import BytesIO
 from typing import List, Dict
 import torch
-from tqdm import tqdm
 from data_types.types import TextToImageRequestType, StableDiffusionExecutionType, ImagePluginType
-from helpers.logger import logger, TqdmToLogger
+from helpers.logger import logger
 from config.consts import stable_diffusion_model_id, stable_diffusion_inference_steps, stable_diffusion_cfg
 from diffusers import DiffusionPipeline
-from helpers.cuda import get_device
+from helpers.cuda import get_device, is_cuda_device
+from helpers.image_encoding import encode_images, get_output_format, get_output_quality
+from helpers.metrics import gauge
+from helpers.progress import ProgressTracker
+from helpers.timing import observe_stage, time_stage
 from helpers.seed import generate_random_seed
-from supabase_helpers.supabase_plugins import get_plugins_from_supabase
-from supabase_helpers.supabase_storage import download_file_from_supabase_bucket
+from helpers.load_config import load_config
+from stable_diffusion.lora_adapter_cache import LoraAdapterCache
+from stable_diffusion.lora_fusion import ComboTracker, FusedDeltaCache, FusedWeights, compute_fused_deltas
+from stable_diffusion.model_loader import load_pipeline, model_cache_dir
+from stable_diffusion.pipeline_compiler import compile_pipeline, parse_batch_sizes, parse_resolutions, update_compiled_forwards
+from stable_diffusion.plugin_registry import get_plugin_registry
+from stable_diffusion.prompt_embedding_cache import PromptEmbeddingCache
 
-lora_cache_dir = "./lora_cache"
-model_cache_dir = "./model_cache"
+config = load_config()
 
 class StableDiffusionManager:
     def __init__(self, model_name: str):
         logger.info(f"Initializing Stable Diffusion with: {model_name}")
         self.model_name = model_name
         self.pipeline = None
-        self.plugin_cache: Dict[str, str] = {}  # Maps LoRA identifiers to local file paths
+        self.plugins = get_plugin_registry()
+        self.max_batch_sizes: Dict[tuple, int] = {}  # Largest batch known to fit into memory per (width, height)
         self.download_weights()
-        self.download_plugins()
+        self.adapters = LoraAdapterCache(self.pipeline, config.LORA_CACHE_MAX_ADAPTERS, config.LORA_CACHE_MAX_MB * 1024 * 1024)
+        self.combos = ComboTracker(config.LORA_FUSION_WINDOW)
+        self.fused_deltas = FusedDeltaCache(config.LORA_FUSION_MAX_MB * 1024 * 1024)
+        self.fused_weights = FusedWeights(self.get_lora_models(), snapshot_device=config.LORA_FUSION_DEVICE)
+        self.prompt_embeddings = PromptEmbeddingCache(config.PROMPT_EMBEDDING_CACHE_MB * 1024 * 1024)
+        self.pending_removals: set[str] = set()  # removed plugins not dropped from the GPU caches yet
+        self.pending_removals_lock = threading.Lock()
+        self.plugins.removal_listeners.append(self.prompt_embeddings.invalidate_plugin)
+        self.plugins.removal_listeners.append(self.on_plugin_removed)
+        self.register_metrics()
+        self.warmup_resolutions = parse_resolutions(config.PIPELINE_WARMUP_RESOLUTIONS)
+        self.warmup_batch_sizes = parse_batch_sizes(config.PIPELINE_WARMUP_BATCH_SIZES) or [1]
+        self.compiled = []
+        if config.PIPELINE_COMPILE:
+            self.compiled = compile_pipeline(self.pipeline, self.warmup_resolutions, self.warmup_batch_sizes, config.PIPELINE_COMPILE_MODE,
+                                             config.PIPELINE_COMPILE_CACHE_DIR, unet_batch_factor=2 if stable_diffusion_cfg > 1 else 1)
+        self.warm_up()
         logger.info("Stable Diffusion is ready.")
 
-    # Download weights for the Stable Diffusion model
+    # Load the Stable Diffusion model, downloading its weights on the first boot only
     def download_weights(self):
         device = get_device()
-        logger.info("Downloading Stable Diffusion model weights...")
+        torch_dtype = torch.float16 if is_cuda_device(device) else torch.float32
+        logger.info("Loading Stable Diffusion model weights...")
         try:
-            self.pipeline = DiffusionPipeline.from_pretrained(
+            self.pipeline = load_pipeline(stable_diffusion_model_id, device, torch_dtype)
+        except Exception:
+            logger.exception("Fast model loading failed, falling back to the Hub")
+            self.pipeline = self.download_pipeline(device, torch_dtype)
+
+        # Disable progress bar
+        self.pipeline.set_progress_bar_config(disable=True)
+        logger.info("Model weights loaded successfully.")
+
+    def download_pipeline(self, device: str, torch_dtype: torch.dtype) -> DiffusionPipeline:
+        try:
+            pipeline = DiffusionPipeline.from_pretrained(
                 stable_diffusion_model_id,
-                torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+                torch_dtype=torch_dtype,
                 cache_dir=model_cache_dir,
                 force_download=False,  # Avoid forcing a re-download
                 local_files_only=False,  # Download from the hub if not found locally
             )
-
-            self.pipeline = self.pipeline.to(device)  # Move to specified device
-
-            # Disable progress bar
-            self.pipeline.set_progress_bar_config(disable=True)
-            logger.info("Model weights downloaded successfully.")
+            return pipeline.to(device)  # Move to specified device
         except Exception as e:
             logger.exception("Error during model weight download")
             raise e
 
-    def download_plugins(self):
-        logger.info("Downloading Plugin (LoRA) weights...")
-        os.makedirs(lora_cache_dir, exist_ok=True)
+    def register_metrics(self):
+        gauge("lora_adapter_cache_hit_ratio", "Share of plugin activations served by resident LoRA adapters", callback=lambda: self.adapters.stats.hit_rate())
+        gauge("lora_adapters_resident", "LoRA adapters loaded into the pipeline", callback=lambda: len(self.adapters.adapters))
+        gauge("prompt_embedding_cache_hit_ratio", "Share of prompts whose embeddings were served from the cache", callback=lambda: self.prompt_embeddings.stats.hit_rate())
+        gauge("lora_fusion_cache_hit_ratio", "Share of fused plugin combinations whose deltas were served from the cache",
+              callback=lambda: self.fused_deltas.hits / max(1, self.fused_deltas.hits + self.fused_deltas.misses))
 
-        plugin_ids = get_plugins_from_supabase()
+    # Run the pipeline once per warm-up resolution and batch size, so the first jobs do not pay for compilation, kernel selection
+    # and allocator growth. The compiled graphs serve exactly these shapes, every other shape runs eager.
+    def warm_up(self):
+        for width, height in self.warmup_resolutions:
+            for batch_size in self.warmup_batch_sizes:
+                start_time = datetime.now()
+                with torch.no_grad():
+                    self.pipeline(["warm-up"] * batch_size, height=height, width=width, num_inference_steps=config.PIPELINE_WARMUP_STEPS, guidance_scale=stable_diffusion_cfg)
+                logger.info(f"Warmed up {batch_size} image(s) at {width}x{height} in {(datetime.now() - start_time).total_seconds():.1f}s")
 
-        for plugin_id in plugin_ids:
-            filename = f"{plugin_id}.safetensors"
-            local_lora_path = os.path.join(
-                lora_cache_dir, filename.replace("/", "_")
-            )
-            if not os.path.exists(local_lora_path):
-                logger.info(f"Downloading Plugin (LoRA): {filename}")
-                try:
-                    downloaded_file = download_file_from_supabase_bucket("plugin_weights", f"{filename}")
-                    with open(local_lora_path, "wb") as f:
-                        f.write(downloaded_file)
-
-                    self.plugin_cache[plugin_id] = local_lora_path
-                except Exception as e:
-                    logger.exception(f"Failed to download LoRA: {filename}")
-            else:
-                logger.info(f"LoRA already downloaded: {filename}")
-                self.plugin_cache[plugin_id] = local_lora_path
+    # Models the plugins (LoRAs) are loaded into
+    def get_lora_models(self) -> Dict[str, torch.nn.Module]:
+        models = {
+            "unet": self.pipeline.unet,
+            "text_encoder": getattr(self.pipeline, "text_encoder", None),
+            "text_encoder_2": getattr(self.pipeline, "text_encoder_2", None),
+        }
+        return {name: model for name, model in models.items() if model is not None}
 
-        logger.info("Plugin (LoRA) weights downloaded successfully.")
+    # Called on the plugin registry thread, the adapters and fused weights are only touched by the thread running the pipeline
+    def on_plugin_removed(self, plugin_id: str):
+        with self.pending_removals_lock:
+            self.pending_removals.add(plugin_id)
 
-    def load_plugins_to_memory(self, plugins: tuple[ImagePluginType]): # type needs to be tuple to allow cache to hash function call
-        for plugin in plugins:
-            self.load_plugin_to_memory(plugin)
+    # Unload removed plugins and drop everything computed from their weights, so a plugin recreated under the same id
+    # never runs with the old weights. Their local files are deleted here, where nothing is loading them anymore.
+    def apply_plugin_removals(self):
+        with self.pending_removals_lock:
+            removed, self.pending_removals = self.pending_removals, set()
 
-    def load_plugin_to_memory(self, plugin: ImagePluginType):
-        logger.debug(f"Loading Plugin (LoRA) weight into memory: {plugin.id}")
-        lora_path = self.plugin_cache.get(plugin.id)
-        if not lora_path:
-            logger.error(f"Plugin (LoRA) not found in cache: {plugin.id}")
-            raise FileNotFoundError(f"Plugin (LoRA) not found: {plugin.id}")
-        self.pipeline.load_lora_weights(lora_path)
+        for plugin_id in removed:
+            fused_key = self.fused_weights.fused_key
+            if fused_key is not None and any(combo_plugin[0] == plugin_id for combo_plugin in fused_key):
+                self.fused_weights.restore()
+            self.fused_deltas.invalidate_plugin(plugin_id)
+            self.adapters.remove_plugin(plugin_id)
+            self.plugins.delete_local_plugin(plugin_id)
 
-    def offload_plugins_from_memory(self):
-        logger.debug("Unloading Plugin (LoRA) weights")
-        self.pipeline.unload_lora_weights()
+    # Switch the pipeline to exactly these plugins, keeping previously used plugins loaded for later requests.
+    # The most frequent plugin combinations run fused into the base weights instead of through the LoRA layers.
+    def load_plugins_to_memory(self, plugins: tuple[ImagePluginType], images: int = 1):
+        self.apply_plugin_removals()
+        combo = self.get_plugin_combo(plugins)
+        if self.fused_weights.fused_key != combo:
+            self.fused_weights.restore()
 
-    def add_plugins_to_prompt(self, data: TextToImageRequestType):
+        self.adapters.activate(plugins, self.plugins.get_plugin_path)
+        if not plugins or config.LORA_FUSION_TOP_K <= 0:
+            return
+
+        self.combos.record(combo, images)
+        if not self.combos.is_popular(combo, config.LORA_FUSION_TOP_K, config.LORA_FUSION_MIN_COUNT):
+            self.fused_weights.restore()
+            return
+
+        deltas = self.fused_deltas.get(combo)
+        if deltas is None:
+            # The adapters were just activated with the weights of this combination, so their deltas are scaled accordingly
+            deltas = compute_fused_deltas(self.get_lora_models(), device=config.LORA_FUSION_DEVICE)
+            if not self.fused_deltas.put(combo, deltas):
+                logger.warning(f"Fused weights of plugin combination {combo} exceed LORA_FUSION_MAX_MB, running it unfused")
+                return
+            logger.info(f"Cached fused weights for plugin combination {combo} ({len(deltas)} layers)")
+
+        self.fused_weights.fuse(combo, deltas)
+        self.pipeline.disable_lora()
+
+    def get_prompt_with_plugins(self, data: TextToImageRequestType) -> str:
+        prompt = data.prompt
         if (data.plugins):
             for plugin in data.plugins:
-                data.prompt += f", <{plugin.id}:{plugin.weight}>"
+                prompt += f", <{plugin.id}:{plugin.weight}>"
 
-        return data
+        return prompt
 
+    # Identifies the same set of plugins with the same weights regardless of their order
+    def get_plugin_combo(self, plugins) -> tuple:
+        return tuple(sorted((plugin.id, plugin.weight) for plugin in plugins or []))
+
+    # Requests sharing this key can be generated together in a single pipeline call
+    def get_batch_key(self, data: TextToImageRequestType) -> tuple:
+        return data.width, data.height, self.get_plugin_combo(data.plugins), stable_diffusion_inference_steps
 
     def text_to_image(self, data: TextToImageRequestType, **kwargs) -> StableDiffusionExecutionType:
-        logger.info("Generating image with data: %s", data)
+        return self.text_to_image_batch([data], **kwargs)[0]
+
+    # Split a request into one single-image request per option, each with its own deterministic seed
+    def get_option_requests(self, data: TextToImageRequestType) -> List[TextToImageRequestType]:
+        if data.seed:
+            seeds = [(data.seed + option) % 2**32 for option in range(data.num_options)]
+        else:
+            seeds = [generate_random_seed() for _ in range(data.num_options)]
+        return [replace(data, num_options=1, seed=seed) for seed in seeds]
+
+    # Generate one image per request in as few denoising passes as fit into memory. All requests must share the same batch key.
+    # With encode=False the images are returned unencoded in raw_image, leaving encoding to the caller.
+    # job_ids, aligned with requests, identify the jobs in progress events.
+    def text_to_image_batch(self, requests: List[TextToImageRequestType], encode: bool = True, job_ids: List[str] = None, **kwargs) -> List[StableDiffusionExecutionType]:
+        logger.info("Generating %s image(s) with data: %s", len(requests), requests)
+
+        batch_keys = set(self.get_batch_key(data) for data in requests)
+        if len(batch_keys) != 1:
+            raise ValueError(f"Requests cannot be batched together: {batch_keys}")
+        data = requests[0]
+        resolution = (data.width, data.height)
 
         start_time = datetime.now()
         with torch.no_grad():
-            seed = data.seed if data.seed else generate_random_seed()
-            generator = torch.manual_seed(seed)
+            seeds = [request.seed if request.seed else generate_random_seed() for request in requests]
+            job_ids = job_ids or [None] * len(requests)
+            images = []
+            step_durations = []  # step durations of the pipeline call that generated each image
             try:
-                inference_steps = stable_diffusion_inference_steps
-                tqdm_out = TqdmToLogger(logger, level=logging.INFO)
-
-                # load plugins
-                if data.plugins:
-                    self.load_plugins_to_memory(tuple(data.plugins))
-
-                data = self.add_plugins_to_prompt(data)
-                print(data.prompt)
-
-                with tqdm(total=inference_steps, desc="text-to-image", file=tqdm_out) as pbar:
-                    def progress_callback(step, t, latents):
-                        pbar.update(1)
-
-                    # generate image
-                    image = self.pipeline(
-                        data.prompt,
-                        negative_prompt=data.negative_prompt,
-                        guidance_scale=stable_diffusion_cfg,
-                        generator=generator,
-                        height=data.height,
-                        width=data.width,
-                        num_inference_steps=inference_steps,
-                        callback=progress_callback,
-                        callback_steps=1,
-                        loras=data.plugins
-                    ).images[0]
+                with time_stage("plugin_load"):
+                    self.load_plugins_to_memory(tuple(data.plugins or ()), len(requests))
+
+                # Compiled graphs only serve modules without injected LoRA layers, plugins never touch the VAE
+                update_compiled_forwards(self.compiled)
+
+                # Start with the largest batch known to fit this resolution and halve it whenever the GPU runs out of memory
+                batch_size = min(len(requests), self.max_batch_sizes.get(resolution, len(requests)))
+                while len(images) < len(requests):
+                    offset = len(images)
+                    try:
+                        chunk = slice(offset, offset + batch_size)
+                        chunk_images, progress = self.run_pipeline(requests[chunk], seeds[chunk], job_ids[chunk])
+                        chunk_images = self.images_to_host(chunk_images)
+                        # Decoding runs asynchronously on the GPU, it is only complete once the images reached the host
+                        observe_stage("denoise", progress.last_step_time - progress.start_time)
+                        observe_stage("vae_decode", time.perf_counter() - progress.last_step_time)
+                        images.extend(chunk_images)
+                        step_durations.extend([progress.step_durations] * len(chunk_images))
+                    except torch.cuda.OutOfMemoryError:
+                        if batch_size == 1:
+                            raise
+                        torch.cuda.empty_cache()
+                        batch_size = batch_size // 2
+                        self.max_batch_sizes[resolution] = batch_size
+                        logger.warning(f"Out of memory at {data.width}x{data.height}, retrying with batches of {batch_size} image(s)")
 
             except Exception as e:
                 logger.error("Error during image generation: %s", e)
                 raise e
-            finally:
-                if data.plugins:
-                    self.offload_plugins_from_memory()
-
-            img_io = BytesIO()
-            image.save(img_io, 'PNG')
-            img_io.seek(0)
 
+            # Runtime is shared by every image of the batch, so each execution reports its share of it
             runtime = int((datetime.now() - start_time).total_seconds() * 1000)
-            logger.info(f"Completed Text-To-Image Request in {runtime/1000} seconds")
+            logger.info(f"Completed Text-To-Image Request ({len(requests)} image(s)) in {runtime/1000} seconds")
+
+            executions = []
+            for image, seed, request, image_step_durations in zip(images, seeds, requests, step_durations):
+                executions.append(StableDiffusionExecutionType(
+                    image=None,
+                    raw_image=image,
+                    runtime=runtime // len(requests),
+                    seed=seed,
+                    step_durations=image_step_durations,
+                    output_format=get_output_format(request.output_format).name,
+                    output_quality=get_output_quality(request.output_quality)
+                ))
+
+            if encode:
+                encoded = encode_images(images, [e.output_format for e in executions], [e.output_quality for e in executions])
+                for execution, image in zip(executions, encoded):
+                    execution.image = image
+                    execution.raw_image = None
+
+            return executions
+
+    # Text encoder outputs for each text, encoded with the active plugins or taken from the cache
+    def get_prompt_embeddings(self, texts: List[str], combo: tuple) -> tuple[torch.Tensor, torch.Tensor]:
+        prompt_embeds = []
+        pooled_prompt_embeds = []
+        for text in texts:
+            entry = self.prompt_embeddings.get((text, combo))
+            if entry is None:
+                embeds, _, pooled, _ = self.pipeline.encode_prompt(
+                    prompt=text,
+                    device=self.pipeline.device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=False
+                )
+                entry = (embeds, pooled)
+                self.prompt_embeddings.put((text, combo), entry)
+            prompt_embeds.append(entry[0])
+            pooled_prompt_embeds.append(entry[1])
+        return torch.cat(prompt_embeds), torch.cat(pooled_prompt_embeds)
+
+    # Convert decoded images (batch, 3, height, width) in [0, 1] to uint8 (height, width, 3) on their device
+    # and copy them in a single transfer into pinned host memory
+    def images_to_host(self, images: torch.Tensor) -> list:
+        images = (images * 255).round_().clamp_(0, 255).to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+        if images.device.type == "cpu":
+            return list(images.numpy())
+
+        host_images = torch.empty(images.shape, dtype=torch.uint8, pin_memory=True)
+        host_images.copy_(images, non_blocking=True)
+        torch.cuda.current_stream(images.device).synchronize()
+        return list(host_images.numpy())
+
+    # Run a single pipeline call for a batch of requests sharing the same batch key.
+    # Returns the decoded images on the device and the progress tracker holding the duration of every denoising step.
+    def run_pipeline(self, requests: List[TextToImageRequestType], seeds: List[int], job_ids: List[str]) -> tuple[torch.Tensor, ProgressTracker]:
+        data = requests[0]
+        inference_steps = stable_diffusion_inference_steps
+        generators = [torch.Generator().manual_seed(seed) for seed in seeds]
+
+        combo = self.get_plugin_combo(data.plugins)
+        with time_stage("encode_prompt"):
+            prompt_embeds, pooled_prompt_embeds = self.get_prompt_embeddings([self.get_prompt_with_plugins(request) for request in requests], combo)
+
+            negative_prompts = [request.negative_prompt or "" for request in requests]
+            if self.pipeline.config.force_zeros_for_empty_prompt:
+                # Same as the pipeline does without a negative prompt, decided per sample so that an image
+                # does not depend on the negative prompts of the jobs it was batched with
+                negative_prompt_embeds = torch.zeros_like(prompt_embeds)
+                negative_pooled_prompt_embeds = torch.zeros_like(pooled_prompt_embeds)
+                indices = [index for index, negative_prompt in enumerate(negative_prompts) if negative_prompt]
+                if indices:
+                    embeds, pooled = self.get_prompt_embeddings([negative_prompts[index] for index in indices], combo)
+                    negative_prompt_embeds[indices] = embeds
+                    negative_pooled_prompt_embeds[indices] = pooled
+            else:
+                negative_prompt_embeds, negative_pooled_prompt_embeds = self.get_prompt_embeddings(negative_prompts, combo)
 
-            return StableDiffusionExecutionType(image=img_io.read(), runtime=runtime, seed=seed)
+        # Started right before the pipeline call, so the first step does not include prompt encoding
+        progress = ProgressTracker(inference_steps, list(dict.fromkeys(job_id for job_id in job_ids if job_id is not None)))
+        images = self.pipeline(
+            prompt_embeds=prompt_embeds,
+            negative_prompt_embeds=negative_prompt_embeds,
+            pooled_prompt_embeds=pooled_prompt_embeds,
+            negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+            guidance_scale=stable_diffusion_cfg,
+            generator=generators,
+            height=data.height,
+            width=data.width,
+            num_inference_steps=inference_steps,
+            callback_on_step_end=progress.callback,
+            output_type="pt",
+            loras=data.plugins
+        ).images
+        return images, progress
 
     # Retrieve the current Stable Diffusion pipeline.
     def get_pipeline(self) -> DiffusionPipeline:
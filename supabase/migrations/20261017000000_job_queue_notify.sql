@@ -0,0 +1,17 @@
+-- Wake up fillers (MODE=filler) as soon as a job is queued, instead of waiting for their next poll.
+-- Fires for new jobs as well as for jobs that are put back into the queue.
+
+CREATE OR REPLACE FUNCTION notify_job_queued() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('job_queue_inserted', NEW.id::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS job_queue_notify_queued ON job_queue;
+
+CREATE TRIGGER job_queue_notify_queued
+    AFTER INSERT OR UPDATE OF job_status ON job_queue
+    FOR EACH ROW
+    WHEN (NEW.job_status = 'queued')
+    EXECUTE FUNCTION notify_job_queued();
@@ -0,0 +1,15 @@
+-- Invalidate the team settings cached by the consumers (see supabase_team.py) as soon as a team changes.
+
+CREATE OR REPLACE FUNCTION notify_team_settings_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('team_settings_changed', COALESCE(NEW.id, OLD.id)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS teams_notify_settings_changed ON teams;
+
+CREATE TRIGGER teams_notify_settings_changed
+    AFTER INSERT OR UPDATE OF nsfw_allowed OR DELETE ON teams
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_team_settings_changed();
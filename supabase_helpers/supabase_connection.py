@@ -1,47 +1,129 @@
-import sys
+import threading
+import time
+from contextlib import contextmanager
 
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 from supabase import create_client
 from supabase._sync.client import SyncClient
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
 from helpers.load_config import load_config
 from helpers.logger import logger
 
 config = load_config()
 _supabaseClient: SyncClient = None
-_supabasePostgres = None
+_supabaseClientLock = threading.Lock()
+_supabasePostgresPool: ThreadedConnectionPool = None
+_supabasePostgresPoolLock = threading.Lock()
+_supabasePostgresPoolSlots: threading.BoundedSemaphore = None
+_supabasePostgresLastUsed: dict[int, float] = {}  # connection id -> last checkin time
 
+# The client (and its pooled keep-alive HTTP session) is shared by all threads, e.g. the upload workers
 def get_supabase():
     global _supabaseClient
-    if _supabaseClient is None:
-        _supabaseClient = create_client(config.SUPABASE_URL, config.SUPABASE_KEY)
+    with _supabaseClientLock:
+        if _supabaseClient is None:
+            _supabaseClient = create_client(config.SUPABASE_URL, config.SUPABASE_KEY)
     return _supabaseClient
 
 
-# Initialize and return a PostgreSQL connection with autocommit enabled.
-def get_supabase_postgres():
-    global _supabasePostgres
+# Open a new PostgreSQL connection with autocommit enabled.
+def create_supabase_postgres_connection():
+    logger.info(f"Connecting to PostgreSQL with config: %s", {"host": config.SUPABASE_POSTGRES_HOST, "user": config.SUPABASE_POSTGRES_USER})
 
-    if _supabasePostgres is not None:
-        return _supabasePostgres
+    conn = psycopg2.connect(
+        user=config.SUPABASE_POSTGRES_USER,
+        password=config.SUPABASE_POSTGRES_PASSWORD,
+        dbname=config.SUPABASE_POSTGRES_DB,
+        host=config.SUPABASE_POSTGRES_HOST,
+        port=config.SUPABASE_POSTGRES_PORT,
+    )
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
 
-    try:
-        logger.info(f"Connecting to PostgreSQL with config: %s", {"host": config.SUPABASE_POSTGRES_HOST, "user": config.SUPABASE_POSTGRES_USER})
+    logger.info("PostgreSQL connection successful")
+    return conn
+
+# Initialize and return the PostgreSQL connection pool shared by all threads. Spawned workers create it on first use,
+# which can happen on several threads at once.
+def get_supabase_postgres_pool() -> ThreadedConnectionPool:
+    global _supabasePostgresPool, _supabasePostgresPoolSlots
+
+    with _supabasePostgresPoolLock:
+        if _supabasePostgresPool is not None:
+            return _supabasePostgresPool
+
+        try:
+            logger.info(f"Creating PostgreSQL connection pool with config: %s", {"host": config.SUPABASE_POSTGRES_HOST, "user": config.SUPABASE_POSTGRES_USER, "min": config.POSTGRES_POOL_MIN, "max": config.POSTGRES_POOL_MAX})
+            pool = ThreadedConnectionPool(
+                config.POSTGRES_POOL_MIN,
+                config.POSTGRES_POOL_MAX,
+                user=config.SUPABASE_POSTGRES_USER,
+                password=config.SUPABASE_POSTGRES_PASSWORD,
+                dbname=config.SUPABASE_POSTGRES_DB,
+                host=config.SUPABASE_POSTGRES_HOST,
+                port=config.SUPABASE_POSTGRES_PORT,
+            )
+        except Exception as e:
+            logger.error(f"PostgreSQL connection failed: {e}")
+            raise
+
+        # The slots are set before the pool is published, so a caller never sees the pool without them
+        _supabasePostgresPoolSlots = threading.BoundedSemaphore(config.POSTGRES_POOL_MAX)
+        _supabasePostgresPool = pool
+        logger.info("PostgreSQL connection pool created")
+        return _supabasePostgresPool
 
-        conn = psycopg2.connect(
-            user=config.SUPABASE_POSTGRES_USER,
-            password=config.SUPABASE_POSTGRES_PASSWORD,
-            dbname=config.SUPABASE_POSTGRES_DB,
-            host=config.SUPABASE_POSTGRES_HOST,
-            port=config.SUPABASE_POSTGRES_PORT,
-        )
-        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+# A connection is healthy if it is open and idle. Connections that were idle for a while are pinged as well,
+# since the server or a proxy may have dropped them in the meantime.
+def is_healthy_connection(conn) -> bool:
+    if conn.closed or conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+        return False
 
-        logger.info("PostgreSQL connection successful")
-        _supabasePostgres = conn
-        return conn
-    except Exception as e:
-        logger.error(f"PostgreSQL connection failed: {e}")
-        sys.exit(1)
+    last_used = _supabasePostgresLastUsed.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < config.POSTGRES_POOL_HEALTHCHECK_IDLE:
+        return True
+
+    try:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT 1;")
+        finally:
+            cursor.close()
+        return True
+    except psycopg2.Error:
+        return False
+
+# Check out a healthy autocommit connection from the pool, waiting while all connections are in use.
+# Broken connections are discarded and transparently replaced.
+@contextmanager
+def get_supabase_postgres():
+    pool = get_supabase_postgres_pool()
+    _supabasePostgresPoolSlots.acquire()
+    conn = None
+    broken = False
+    try:
+        while True:
+            conn = pool.getconn()
+            if is_healthy_connection(conn):
+                break
+            logger.warning("Discarding broken PostgreSQL connection")
+            _supabasePostgresLastUsed.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            conn = None
 
+        if not conn.autocommit:
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
 
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        if conn is not None:
+            broken = broken or conn.closed or conn.get_transaction_status() != TRANSACTION_STATUS_IDLE
+            if broken:
+                _supabasePostgresLastUsed.pop(id(conn), None)
+            else:
+                _supabasePostgresLastUsed[id(conn)] = time.monotonic()
+            pool.putconn(conn, close=bool(broken))
+        _supabasePostgresPoolSlots.release()
@@ -1,40 +1,57 @@
 import json
 from data_types.types import StableDiffusionExecutionType, SupabaseJobQueueType, JobType
+from helpers.image_formats import get_image_format
+from helpers.timing import time_stage
 from supabase_helpers.supabase_connection import get_supabase_postgres
-from supabase_helpers.supabase_storage import upload_images_to_supabase_bucket
+from supabase_helpers.supabase_storage import SupabaseUploadError, delete_files_from_supabase_bucket, upload_images_to_supabase_bucket
 
 
+# Upload the images of a job and insert their rows. When the job fails here, the images that were uploaded are deleted
+# again since no row references them; the error names the files that could not be deleted.
 def create_supabase_image_entities(executions: list[StableDiffusionExecutionType], job_data:  SupabaseJobQueueType):
+    images_data = [execution.image for execution in executions]
+    image_formats = [get_image_format(execution.output_format) for execution in executions]
     try:
-        images_data = [execution.image for execution in executions]
-        filenames = upload_images_to_supabase_bucket("images", images_data)
-    except Exception:
-        raise Exception("image upload to bucket failed")
+        filenames = upload_images_to_supabase_bucket("images", images_data, image_formats)
+    except SupabaseUploadError as e:
+        e.orphaned = delete_files_from_supabase_bucket("images", e.paths)
+        raise
 
-    supabase = get_supabase_postgres()
     try:
-        cursor = supabase.cursor()
-
-        # Prepare data for batch insertion
-        insert_values = []
-        for filename, execution in zip(filenames, executions):
-            data = {
-                "filename": f"{filename}.png",
-                "seed": execution.seed,
-                "runtime": execution.runtime
-            }
-            insert_values.append((json.dumps(data), False, str(job_data.id)))
-
-        # Build the INSERT query for multiple rows
-        args_str = ','.join(cursor.mogrify("(%s, %s, %s)", x).decode('utf-8') for x in insert_values)
-        cursor.execute("INSERT INTO images (data, is_public, job_id) VALUES " + args_str + ";")
-        supabase.commit()
-
-  #      create_supabase_image_relations(job_data)
-
+        insert_supabase_images(executions, job_data, filenames, image_formats)
     except Exception as e:
-        supabase.rollback()
-        raise e
+        orphaned = delete_files_from_supabase_bucket("images", [f"{filename}.{image_format.extension}" for filename, image_format in zip(filenames, image_formats)])
+        raise Exception(f"image insert failed: {e}" + (f" (uploaded files left in the bucket: {orphaned})" if orphaned else ""))
+
+def insert_supabase_images(executions: list[StableDiffusionExecutionType], job_data: SupabaseJobQueueType, filenames: list[str], image_formats: list):
+    with time_stage("db_write"), get_supabase_postgres() as supabase:
+        try:
+            cursor = supabase.cursor()
+
+            # Prepare data for batch insertion
+            insert_values = []
+            for filename, execution, image_format in zip(filenames, executions, image_formats):
+                data = {
+                    "filename": f"{filename}.{image_format.extension}",
+                    "format": image_format.name,
+                    "content_type": image_format.content_type,
+                    "quality": execution.output_quality if image_format.lossy else None,
+                    "bytes": len(execution.image),
+                    "seed": execution.seed,
+                    "runtime": execution.runtime
+                }
+                insert_values.append((json.dumps(data), False, str(job_data.id)))
+
+            # Build the INSERT query for multiple rows
+            args_str = ','.join(cursor.mogrify("(%s, %s, %s)", x).decode('utf-8') for x in insert_values)
+            cursor.execute("INSERT INTO images (data, is_public, job_id) VALUES " + args_str + ";")
+            supabase.commit()
+
+      #      create_supabase_image_relations(job_data)
+
+        except Exception as e:
+            supabase.rollback()
+            raise e
 
 # def create_supabase_image_relations(job_data: SupabaseJobQueueType):
     # if (job_data.job_type == JobType.TEXT_TO_IMAGE):
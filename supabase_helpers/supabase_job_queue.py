@@ -1,14 +1,26 @@
 import json
+from typing import Optional
+
+from psycopg2.extras import execute_values
 
 from data_types.types import JobStatus
 from helpers.logger import logger
+from helpers.timing import time_stage
 from supabase_helpers.supabase_connection import get_supabase_postgres
 
+_columnTypes: dict[tuple[str, str], str] = {}
+
+# Look up the SQL type of a column, needed to cast the untyped literals of a VALUES list
+def get_column_type(conn, table: str, column: str) -> str:
+    key = (table, column)
+    if key not in _columnTypes:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT format_type(atttypid, atttypmod) FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s;", (table, column))
+            _columnTypes[key] = cursor.fetchone()[0]
+    return _columnTypes[key]
+
 # Update the status of a job in the job_queue table.
 def update_supabase_job_queue(job_id, job_status: JobStatus, execution_metadata_update=None):
-    conn = get_supabase_postgres()
-    cursor = conn.cursor()
-
     try:
         sql = """
             UPDATE job_queue
@@ -24,9 +36,55 @@ def update_supabase_job_queue(job_id, job_status: JobStatus, execution_metadata_
         sql += " WHERE id = %s;"
         params.append(job_id)
 
-        cursor.execute(sql, tuple(params))
+        with time_stage("db_write"), get_supabase_postgres() as conn, conn.cursor() as cursor:
+            cursor.execute(sql, tuple(params))
         logger.info(f"Updated job {job_id} status to {job_status.value}.")
     except Exception as e:
         logger.error(f"Failed to update job {job_id} status: {e}")
-    finally:
-        cursor.close()
\ No newline at end of file
+
+# Put jobs that never reached RabbitMQ back into the queue with a single statement.
+def revert_supabase_jobs_to_queued(job_ids: list[str]):
+    try:
+        with get_supabase_postgres() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                "UPDATE job_queue SET job_status = %s WHERE id IN %s AND job_status = %s;",
+                (JobStatus.QUEUED.value, tuple(job_ids), JobStatus.ASSIGNED.value)
+            )
+            logger.info(f"Reverted {cursor.rowcount} job(s) to {JobStatus.QUEUED.value}: {job_ids}")
+    except Exception as e:
+        logger.error(f"Failed to revert jobs {job_ids} to {JobStatus.QUEUED.value}: {e}")
+
+
+# Apply many job status updates with a single UPDATE ... FROM (VALUES ...). Updates must be given in the order they happened:
+# per job the last status wins, and the last execution metadata replaces the stored one like sequential updates would.
+def update_supabase_job_queue_bulk(updates: list[tuple[str, JobStatus, Optional[dict]]]):
+    latest = {}
+    for job_id, job_status, execution_metadata_update in updates:
+        if execution_metadata_update is None and job_id in latest:
+            execution_metadata_update = latest[job_id][1]
+        latest[job_id] = (job_status, execution_metadata_update)
+
+    rows = [
+        (job_id, job_status.value, json.dumps(execution_metadata_update) if execution_metadata_update is not None else None)
+        for job_id, (job_status, execution_metadata_update) in latest.items()
+    ]
+    if not rows:
+        return
+
+    with time_stage("db_write"), get_supabase_postgres() as conn, conn.cursor() as cursor:
+        id_type = get_column_type(conn, "job_queue", "id")
+        status_type = get_column_type(conn, "job_queue", "job_status")
+        execute_values(
+            cursor,
+            """
+            UPDATE job_queue
+            SET job_status = v.job_status,
+                execution_metadata = COALESCE(v.execution_metadata, job_queue.execution_metadata)
+            FROM (VALUES %s) AS v(id, job_status, execution_metadata)
+            WHERE job_queue.id = v.id;
+            """,
+            rows,
+            template=f"(%s::{id_type}, %s::{status_type}, %s::jsonb)",
+            page_size=len(rows)
+        )
+        logger.info(f"Applied {len(updates)} status update(s) to {len(rows)} job(s).")
@@ -0,0 +1,47 @@
+import select
+import time
+from helpers.logger import logger
+from supabase_helpers.supabase_connection import create_supabase_postgres_connection
+
+RECONNECT_DELAY = 5  # seconds
+
+# Waits for PostgreSQL notifications on a dedicated connection, since LISTEN is bound to the session that issued it
+class SupabaseListener:
+    def __init__(self, channels: list[str]):
+        self.channels = channels
+        self.conn = None
+
+    def connect(self):
+        self.conn = create_supabase_postgres_connection()
+        cursor = self.conn.cursor()
+        try:
+            for channel in self.channels:
+                cursor.execute(f"LISTEN {channel};")
+            logger.info(f"Listening for PostgreSQL notifications on: {self.channels}")
+        finally:
+            cursor.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    # Wait up to timeout seconds and return the received notifications. A lost connection is re-established on the next call.
+    def wait(self, timeout: float) -> list:
+        timeout = max(0, timeout)  # select rejects negative timeouts
+        try:
+            if self.conn is None:
+                self.connect()
+
+            if select.select([self.conn], [], [], timeout) == ([], [], []):
+                return []
+
+            self.conn.poll()
+            notifies = list(self.conn.notifies)
+            self.conn.notifies.clear()
+            return notifies
+        except Exception as e:
+            logger.error(f"PostgreSQL notification listener failed: {e}. Reconnecting in {RECONNECT_DELAY} seconds...")
+            self.close()
+            time.sleep(min(timeout, RECONNECT_DELAY))
+            return []
@@ -5,10 +5,9 @@ from supabase_helpers.supabase_connection import get_supabase, get_supabase_post
 def get_plugins_from_supabase():
     try:
         logger.info("Fetching an up-to-date list of plugins from Supabase...")
-        supabase = get_supabase_postgres()
-        cursor = supabase.cursor()
-        cursor.execute("SELECT id FROM plugins")
-        data = cursor.fetchall()
+        with get_supabase_postgres() as supabase, supabase.cursor() as cursor:
+            cursor.execute("SELECT id FROM plugins")
+            data = cursor.fetchall()
         plugin_ids = [t[0] for t in data]
         return plugin_ids
     except Exception as e:
@@ -1,26 +1,95 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
 from helpers.filename import get_filename
+from helpers.image_formats import IMAGE_FORMATS, ImageFormat
+from helpers.load_config import load_config
 from helpers.logger import logger
+from helpers.timing import time_stage
 from supabase_helpers.supabase_connection import get_supabase
 
-def upload_image_to_supabase_bucket(bucket: str, data: bytes) -> str:
+config = load_config()
+_uploadExecutor: ThreadPoolExecutor = None
+
+# Raised when some files of a batch could not be uploaded. filenames holds None for every failed file, paths the objects
+# that were uploaded. orphaned lists the uploaded objects that could not be cleaned up afterwards.
+class SupabaseUploadError(Exception):
+    def __init__(self, filenames: list[Optional[str]], paths: list[str], errors: dict[int, Exception]):
+        super().__init__()
+        self.filenames = filenames
+        self.paths = paths
+        self.errors = errors
+        self.orphaned: list[str] = []
+
+    def __str__(self):
+        message = f"{len(self.errors)} of {len(self.filenames)} upload(s) failed: " + ", ".join(f"#{index}: {error}" for index, error in self.errors.items())
+        if self.orphaned:
+            message += f" (uploaded files left in the bucket: {self.orphaned})"
+        return message
+
+def get_upload_executor() -> ThreadPoolExecutor:
+    global _uploadExecutor
+    if _uploadExecutor is None:
+        _uploadExecutor = ThreadPoolExecutor(max_workers=config.UPLOAD_WORKERS, thread_name_prefix="upload")
+    return _uploadExecutor
+
+def upload_image_to_supabase_bucket(bucket: str, data: Union[bytes, memoryview], image_format: ImageFormat = IMAGE_FORMATS["png"]) -> str:
     filename = get_filename()
+    path = f"{filename}.{image_format.extension}"
+    if isinstance(data, memoryview):
+        data = data.tobytes()  # the storage client only accepts bytes
 
-    try:
-        supabase = get_supabase()
-        supabase.storage.from_(bucket).upload(path=f"{filename}.png", file=data, file_options={"content-type": "image/png"})
-        return filename
-    except Exception as e:
-        logger.exception("Failed to upload image to supabase: ", e)
-        raise e
+    supabase = get_supabase()
+    for attempt in range(config.UPLOAD_RETRIES + 1):
+        try:
+            # A failed attempt may still have stored the object, so retries overwrite it
+            file_options = {"content-type": image_format.content_type, "upsert": "true" if attempt > 0 else "false"}
+            supabase.storage.from_(bucket).upload(path=path, file=data, file_options=file_options)
+            return filename
+        except Exception as e:
+            if attempt == config.UPLOAD_RETRIES:
+                logger.exception(f"Failed to upload image to supabase: {e}")
+                raise e
+
+            # Exponential backoff with full jitter, so retries of a batch do not hit storage at the same time
+            delay = random.uniform(0, config.UPLOAD_RETRY_BACKOFF_MS * 2 ** attempt) / 1000
+            logger.warning(f"Upload of {path} failed (attempt {attempt + 1}), retrying in {delay:.2f}s: {e}")
+            time.sleep(delay)
 
-def upload_images_to_supabase_bucket(bucket: str, files: list[bytes]) -> list[str]:
+# Upload all files concurrently, returning their filenames (without extension) in the order of the given files
+def upload_images_to_supabase_bucket(bucket: str, files: list[Union[bytes, memoryview]], image_formats: list[ImageFormat]) -> list[str]:
+    executor = get_upload_executor()
     filenames = []
-    for file in files:
-        filename = upload_image_to_supabase_bucket(bucket, file)
-        filenames.append(filename)
+    errors = {}
+    with time_stage("upload"):
+        futures = [executor.submit(upload_image_to_supabase_bucket, bucket, file, image_format) for file, image_format in zip(files, image_formats)]
+        for index, future in enumerate(futures):
+            try:
+                filenames.append(future.result())
+            except Exception as e:
+                filenames.append(None)
+                errors[index] = e
+
+    if errors:
+        paths = [f"{filename}.{image_format.extension}" for filename, image_format in zip(filenames, image_formats) if filename]
+        logger.error(f"{len(errors)} of {len(files)} upload(s) to bucket {bucket} failed, uploaded: {paths}")
+        raise SupabaseUploadError(filenames, paths, errors)
 
     return filenames
 
+# Delete objects from a bucket, returning the paths that could not be deleted
+def delete_files_from_supabase_bucket(bucket: str, paths: list[str]) -> list[str]:
+    if not paths:
+        return []
+    try:
+        get_supabase().storage.from_(bucket).remove(paths)
+        logger.info(f"Deleted {len(paths)} file(s) from bucket {bucket}: {paths}")
+        return []
+    except Exception as e:
+        logger.error(f"Failed to delete {paths} from bucket {bucket}: {e}")
+        return paths
+
 def download_file_from_supabase_bucket(bucket: str, filename: str):
     try:
         supabase = get_supabase()
@@ -28,4 +97,4 @@ def download_file_from_supabase_bucket(bucket: str, filename: str):
         return response
     except Exception as e:
         logger.exception("Failed to download image from supabase: ", e)
-        raise e
\ No newline at end of file
+        raise e
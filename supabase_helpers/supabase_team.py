@@ -1,13 +1,85 @@
+import threading
+import time
+from typing import Optional
+from helpers.load_config import load_config
 from helpers.logger import logger
 from supabase_helpers.supabase_connection import get_supabase_postgres
+from supabase_helpers.supabase_listen import SupabaseListener
+
+TEAM_SETTINGS_NOTIFY_CHANNEL = "team_settings_changed"
+REFRESH_RETRY_DELAY = 5  # seconds before a failed refresh is retried
+
+config = load_config()
+_teamSettings = None
+_teamSettingsLock = threading.Lock()
+
+# Process-wide cache of the team settings, refreshed in bulk every TEAM_SETTINGS_TTL seconds and as soon as a team
+# row changes. Lookups only read the in-memory snapshot. A failed refresh keeps serving the previous snapshot.
+class TeamSettingsCache:
+    def __init__(self):
+        self.nsfw_teams: Optional[frozenset[str]] = None
+        self.next_refresh = 0
+        self.loaded = threading.Event()
+        self.listener = SupabaseListener([TEAM_SETTINGS_NOTIFY_CHANNEL])
+        self.thread = threading.Thread(target=self.run, name="team-settings", daemon=True)
+
+    def start(self):
+        self.refresh()
+        self.thread.start()
+
+    def refresh(self):
+        try:
+            with get_supabase_postgres() as supabase, supabase.cursor() as cursor:
+                cursor.execute("SELECT id FROM teams WHERE nsfw_allowed = TRUE")
+                data = cursor.fetchall()
+            self.nsfw_teams = frozenset(str(row[0]) for row in data)
+            self.next_refresh = time.monotonic() + config.TEAM_SETTINGS_TTL
+            self.loaded.set()
+            logger.info(f"Team settings refreshed, {len(self.nsfw_teams)} team(s) with NSFW enabled")
+        except Exception as e:
+            # Back off instead of retrying right away, which would hammer the database during an outage
+            self.next_refresh = time.monotonic() + REFRESH_RETRY_DELAY
+            logger.error(f"Failed to refresh team settings, keeping the previous settings and retrying in {REFRESH_RETRY_DELAY} seconds: {e}")
+
+    # Every refresh moves next_refresh into the future, so the listener always waits a positive timeout
+    def run(self):
+        while True:
+            timeout = self.next_refresh - time.monotonic()
+            if timeout <= 0:
+                self.refresh()
+                continue
+
+            notifies = self.listener.wait(timeout)
+            if notifies:
+                logger.info(f"Team settings changed for {len(notifies)} team(s), refreshing")
+                self.refresh()
+
+    def nsfw_allowed(self, team_id: str) -> Optional[bool]:
+        nsfw_teams = self.nsfw_teams
+        if nsfw_teams is None:
+            return None
+        return str(team_id) in nsfw_teams
+
+def get_team_settings() -> TeamSettingsCache:
+    global _teamSettings
+
+    with _teamSettingsLock:
+        if _teamSettings is None:
+            _teamSettings = TeamSettingsCache()
+            _teamSettings.start()
+    return _teamSettings
 
 def team_nsfw_allowed(team_id: str) -> bool:
+    nsfw_allowed = get_team_settings().nsfw_allowed(team_id)
+    if nsfw_allowed is not None:
+        return nsfw_allowed
+
+    # The settings could not be loaded yet, look the team up directly
     try:
-        supabase = get_supabase_postgres()
-        cursor = supabase.cursor()
-        cursor.execute("SELECT id FROM teams WHERE id = %s AND nsfw_allowed = TRUE", (team_id,))
-        data = cursor.fetchall()
+        with get_supabase_postgres() as supabase, supabase.cursor() as cursor:
+            cursor.execute("SELECT id FROM teams WHERE id = %s AND nsfw_allowed = TRUE", (team_id,))
+            data = cursor.fetchall()
         return len(data) > 0
     except Exception as e:
         logger.error("Failed to fetch team from database for NSFW check. Defaulting to NSFW disabled: ", e)
-        return False
\ No newline at end of file
+        return False
@@ -0,0 +1,78 @@
+import json
+from contextlib import contextmanager
+from unittest.mock import MagicMock
+
+import pytest
+
+pytest.importorskip("pydantic")
+pytest.importorskip("psycopg2")
+pytest.importorskip("pika")
+pytest.importorskip("supabase")
+
+from data_types.types import JobStatus
+from rabbitmq import rabbitmq_writer
+from supabase_helpers import supabase_job_queue
+
+
+@pytest.fixture
+def executed_rows(monkeypatch):
+    rows = []
+
+    @contextmanager
+    def get_supabase_postgres():
+        yield MagicMock()
+
+    monkeypatch.setattr(supabase_job_queue, "get_supabase_postgres", get_supabase_postgres)
+    monkeypatch.setattr(supabase_job_queue, "get_column_type", lambda conn, table, column: "text")
+    monkeypatch.setattr(supabase_job_queue, "execute_values", lambda cursor, sql, values, **kwargs: rows.extend(values))
+    return rows
+
+
+def test_bulk_update_folds_updates_per_job(executed_rows):
+    supabase_job_queue.update_supabase_job_queue_bulk([
+        ("a", JobStatus.RUNNING, {"started_at": "t0"}),
+        ("b", JobStatus.RUNNING, None),
+        ("a", JobStatus.SUCCEEDED, None),
+        ("b", JobStatus.FAILED, {"error": "boom"}),
+        ("c", JobStatus.RUNNING, {"started_at": "t1"}),
+        ("c", JobStatus.SUCCEEDED, {"runtime": 10}),
+    ])
+
+    assert executed_rows == [
+        ("a", "succeeded", json.dumps({"started_at": "t0"})),
+        ("b", "failed", json.dumps({"error": "boom"})),
+        ("c", "succeeded", json.dumps({"runtime": 10})),
+    ]
+
+
+def test_bulk_update_raises_when_the_write_fails(monkeypatch, executed_rows):
+    def fail(*args, **kwargs):
+        raise Exception("connection lost")
+
+    monkeypatch.setattr(supabase_job_queue, "execute_values", fail)
+    with pytest.raises(Exception, match="connection lost"):
+        supabase_job_queue.update_supabase_job_queue_bulk([("a", JobStatus.RUNNING, None)])
+
+
+def test_failed_write_is_retried_in_place(monkeypatch):
+    attempts = []
+
+    def update_bulk(updates):
+        attempts.append(updates)
+        if len(attempts) < 3:
+            raise Exception("database unavailable")
+
+    monkeypatch.setattr(rabbitmq_writer, "update_supabase_job_queue_bulk", update_bulk)
+    monkeypatch.setattr(rabbitmq_writer.time, "sleep", lambda seconds: None)
+    rabbitmq = MagicMock()
+
+    rabbitmq_writer.write_events(rabbitmq, [
+        ("m1", json.dumps({"id": "a", "job_status": "running"})),
+        ("m2", "not json"),
+        ("m3", json.dumps({"id": "a", "job_status": "succeeded", "execution_metadata": {"runtime": 10}})),
+    ])
+
+    expected = [("a", JobStatus.RUNNING, None), ("a", JobStatus.SUCCEEDED, {"runtime": 10})]
+    assert attempts == [expected] * 3
+    rabbitmq.basic_nack.assert_called_once_with("m2", requeue=False)
+    assert [call.args for call in rabbitmq.basic_ack.call_args_list] == [("m1",), ("m3",)]
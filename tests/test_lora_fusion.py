@@ -0,0 +1,116 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+peft = pytest.importorskip("peft")
+
+from peft import LoraConfig, inject_adapter_in_model
+from stable_diffusion.lora_fusion import ComboTracker, FusedDeltaCache, FusedWeights, compute_fused_deltas, get_lora_layers
+
+
+class TinyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.to_q = torch.nn.Linear(16, 16)
+        self.conv = torch.nn.Conv2d(4, 4, 3, padding=1)
+
+    def forward(self, x, image):
+        return self.to_q(x), self.conv(image)
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    model = TinyModel()
+    for adapter in ("first", "second"):
+        config = LoraConfig(r=4, lora_alpha=8, target_modules=["to_q", "conv"])
+        model = inject_adapter_in_model(config, model, adapter_name=adapter)
+
+    # LoRA B matrices start out as zeros, which would make every delta zero
+    for name, parameter in model.named_parameters():
+        if "lora_" in name:
+            torch.nn.init.normal_(parameter, std=0.1)
+    model.eval()
+    return model
+
+
+def activate(model, weights):
+    for layer in get_lora_layers({"unet": model}).values():
+        layer.enable_adapters(True)
+        layer.set_adapter(list(weights))
+        for adapter, weight in weights.items():
+            layer.set_scale(adapter, weight)
+
+
+def disable(model):
+    for layer in get_lora_layers({"unet": model}).values():
+        layer.enable_adapters(False)
+
+
+def test_fused_weights_match_unfused_adapters(model):
+    x = torch.randn(2, 16)
+    image = torch.randn(1, 4, 8, 8)
+    activate(model, {"first": 0.8, "second": 0.3})
+
+    with torch.no_grad():
+        unfused = model(x, image)
+        deltas = compute_fused_deltas({"unet": model})
+        disable(model)
+
+        fused_weights = FusedWeights({"unet": model})
+        fused_weights.fuse("combo", deltas)
+        fused = model(x, image)
+
+    for expected, actual in zip(unfused, fused):
+        assert torch.allclose(expected, actual, atol=1e-5)
+
+
+def test_restore_brings_back_exact_base_weights(model):
+    layers = get_lora_layers({"unet": model})
+    base_weights = {name: layer.base_layer.weight.detach().clone() for name, layer in layers.items()}
+
+    activate(model, {"first": 1.0})
+    fused_weights = FusedWeights({"unet": model})
+    fused_weights.fuse("first", compute_fused_deltas({"unet": model}))
+    activate(model, {"second": 0.5})
+    fused_weights.fuse("second", compute_fused_deltas({"unet": model}))
+    fused_weights.restore()
+
+    for name, layer in layers.items():
+        assert torch.equal(layer.base_layer.weight, base_weights[name])
+    assert fused_weights.fused_key is None
+
+
+def test_combo_tracker_only_reports_frequent_combinations():
+    tracker = ComboTracker(window=10)
+    tracker.record("popular", 6)
+    tracker.record("rare", 2)
+    assert tracker.is_popular("popular", top_k=1, min_count=5)
+    assert not tracker.is_popular("rare", top_k=2, min_count=5)
+
+    # Old images fall out of the window
+    tracker.record("rare", 8)
+    assert not tracker.is_popular("popular", top_k=1, min_count=5)
+    assert tracker.is_popular("rare", top_k=1, min_count=5)
+
+
+def test_fused_delta_cache_evicts_least_recently_used():
+    entry_bytes = 16 * 16 * 4
+    cache = FusedDeltaCache(max_bytes=2 * entry_bytes)
+    for key in ("a", "b"):
+        cache.put(key, {"layer": torch.zeros(16, 16)})
+    cache.get("a")
+    cache.put("c", {"layer": torch.zeros(16, 16)})
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert not cache.put("huge", {"layer": torch.zeros(64, 64)})
+
+
+def test_fused_delta_cache_drops_combos_of_removed_plugin():
+    cache = FusedDeltaCache(max_bytes=1024 * 1024)
+    for key in ((("a", 1.0),), (("a", 0.5), ("b", 1.0)), (("b", 1.0),)):
+        cache.put(key, {"layer": torch.zeros(4, 4)})
+
+    cache.invalidate_plugin("a")
+
+    assert list(cache.entries) == [(("b", 1.0),)]
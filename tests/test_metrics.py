@@ -0,0 +1,46 @@
+import pytest
+
+pytest.importorskip("pydantic")
+
+from helpers.metrics import Counter, Histogram, MetricsRegistry
+
+
+# Minimal parser of the text exposition format, failing on anything Prometheus would reject the scrape for
+def parse_exposition(text: str) -> dict:
+    families = {}
+    current = None
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, metric_type = line.split(" ")
+            assert name not in families, f"second TYPE line for {name}"
+            families[name] = {"type": metric_type, "samples": []}
+            current = name
+        elif line.startswith("# HELP "):
+            continue
+        elif line:
+            sample, value = line.rsplit(" ", 1)
+            assert sample.split("{")[0].startswith(current), f"sample {sample} outside of its family {current}"
+            families[current]["samples"].append((sample, float(value)))
+    return families
+
+
+def test_supervisor_and_worker_metrics_merge_into_one_family():
+    worker = MetricsRegistry()
+    worker.register(Histogram("stage_duration_seconds", "Stages", ("stage",), buckets=(1,))).labels("denoise").observe(0.5)
+    worker.register(Counter("jobs_finished_total", "Jobs", ("outcome",))).labels("succeeded").inc()
+
+    supervisor = MetricsRegistry()
+    supervisor.register(Histogram("stage_duration_seconds", "Stages", ("stage",), buckets=(1,)))  # registered, never observed
+    supervisor.register(Counter("rabbitmq_publish_failed_total", "Failed publishes"))  # no samples either
+    supervisor.register(Counter("consumer_restarts_total", "Restarts")).inc(2)
+    supervisor.collectors.append(lambda: [('worker="0"', worker.render()), ('worker="1"', worker.render())])
+
+    families = parse_exposition(supervisor.render())
+
+    assert set(families) == {"stage_duration_seconds", "jobs_finished_total", "consumer_restarts_total"}
+    assert families["consumer_restarts_total"]["samples"] == [("consumer_restarts_total", 2)]
+    assert families["jobs_finished_total"]["samples"] == [
+        ('jobs_finished_total{worker="0",outcome="succeeded"}', 1),
+        ('jobs_finished_total{worker="1",outcome="succeeded"}', 1),
+    ]
+    assert ('stage_duration_seconds_count{worker="1",stage="denoise"}', 1) in families["stage_duration_seconds"]["samples"]
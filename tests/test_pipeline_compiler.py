@@ -0,0 +1,71 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from stable_diffusion.pipeline_compiler import ShapeDispatchedForward, parse_batch_sizes, parse_resolutions, update_compiled_forwards
+
+
+class CountingModule(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(4, 4, 3, padding=1)
+
+    def forward(self, sample):
+        return self.conv(sample)
+
+
+# Stands in for a PEFT LoRA wrapper around a base layer
+class FakeLoraLayer(torch.nn.Module):
+    def __init__(self, base_layer):
+        super().__init__()
+        self.base_layer = base_layer
+        self.lora_A = torch.nn.ModuleDict()
+
+    def forward(self, sample):
+        return self.base_layer(sample)
+
+
+def test_parse_resolutions():
+    assert parse_resolutions("1024x1024, 1152X896,") == [(1024, 1024), (1152, 896)]
+    assert parse_resolutions("") == []
+    assert parse_batch_sizes("1, 2,4,") == [1, 2, 4]
+
+
+def test_compiled_forward_only_serves_warmed_shapes():
+    torch.manual_seed(0)
+    module = CountingModule()
+    eager = CountingModule()
+    eager.load_state_dict(module.state_dict())
+    dispatched = ShapeDispatchedForward(module, [(2, 8, 8)], backend="eager")
+
+    calls = []
+    compiled = dispatched.compiled
+    dispatched.compiled = lambda *args, **kwargs: calls.append("compiled") or compiled(*args, **kwargs)
+
+    common = torch.randn(2, 4, 8, 8)
+    uncommon = torch.randn(2, 4, 8, 16)
+    other_batch = torch.randn(3, 4, 8, 8)
+    assert torch.allclose(module(common), eager(common))
+    assert torch.allclose(module(uncommon), eager(uncommon))
+    assert torch.allclose(module(other_batch), eager(other_batch))
+    assert calls == ["compiled"]
+
+    dispatched.enabled = False
+    module(common)
+    assert calls == ["compiled"]
+
+
+def test_modules_with_lora_layers_run_eager():
+    module = CountingModule()
+    untouched = CountingModule()
+    dispatched = ShapeDispatchedForward(module, [(2, 8, 8)], backend="eager")
+    other = ShapeDispatchedForward(untouched, [(2, 8, 8)], backend="eager")
+
+    update_compiled_forwards([dispatched, other])
+    assert dispatched.enabled and other.enabled
+
+    # Stays eager even when the adapter is disabled or fused, the wrapper is still in the graph
+    module.conv = FakeLoraLayer(module.conv)
+    update_compiled_forwards([dispatched, other])
+    assert not dispatched.enabled
+    assert other.enabled